@@ -1,11 +1,28 @@
 from dependencies import *
 from model import *
 from background import *
+from save_data import *
+from surrogate import *
+from instrumentation import *
+from model_cache import *
 
 ### helper functions to perform Monte Carlo sampling
 
 # generate parameter values to iterate through
-def sample_params(iters,param_ranges,dt,t_max):
+# method: None for independent draws from the global np.random state (as before), or "random" (plain MC),
+#         "lhs" (Latin hypercube) or "sobol" (scrambled Sobol) for a seeded design generated chunk by chunk
+#         with sample_params_chunk, so sharded runs reproduce it bit-for-bit
+@timed_phase("sample_params")
+def sample_params(iters,param_ranges,dt,t_max,method=None,seed=None,chunk_size=None):
+    if method is not None:
+        if seed is None:
+            seed = np.random.SeedSequence().entropy # every chunk has to share one seed
+        chunk_size = chunk_size or iters
+        chunks = [sample_params_chunk(min(chunk_size, iters-start),param_ranges,dt,t_max,method=method,seed=seed,
+                                      chunk=start//chunk_size,chunk_size=chunk_size)
+                  for start in range(0, iters, chunk_size)]
+        return {key: np.concatenate([chunk[key] for chunk in chunks]) for key in chunks[0]}
+
     params = {}
     
     # fixed timing parameters
@@ -24,6 +41,47 @@ def sample_params(iters,param_ranges,dt,t_max):
     
     return params
 
+# independent random stream for one chunk of a seeded design
+def chunk_rng(seed,chunk):
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(chunk,)))
+
+# n points in the unit hypercube for one chunk of a design
+# sobol: points chunk*chunk_size onwards of a single scrambled sequence (balanced for powers of 2)
+# lhs: a Latin hypercube stratified within the chunk; random: independent uniform draws
+def unit_samples(n,dims,method="sobol",seed=None,chunk=0,chunk_size=None):
+    if method == "sobol":
+        sampler = st.qmc.Sobol(dims, scramble=True, seed=np.random.default_rng(seed))
+        if chunk:
+            sampler.fast_forward(chunk*(chunk_size or n))
+        return sampler.random(n)
+    elif method == "lhs":
+        return st.qmc.LatinHypercube(dims, seed=chunk_rng(seed,chunk)).random(n)
+    elif method == "random":
+        return chunk_rng(seed,chunk).random((n, dims))
+    raise ValueError(f"unknown sampling method {method}")
+
+# generate one chunk (iterations chunk*chunk_size onwards) of a seeded parameter design
+def sample_params_chunk(n,param_ranges,dt,t_max,method="sobol",seed=None,chunk=0,chunk_size=None):
+    ranged = [key for key,val in param_ranges.items() if isinstance(val,tuple)]
+    u = unit_samples(n, len(ranged)+1, method=method, seed=seed, chunk=chunk, chunk_size=chunk_size)
+
+    # fixed timing parameters
+    params = {'dt': np.full(n, dt), 't_max': np.full(n, t_max)}
+
+    # scale the design onto the ranges
+    for key,val in param_ranges.items():
+        if isinstance(val,tuple):
+            low, high = val
+            params[key] = low + (high-low)*u[:, ranged.index(key)]
+        else:
+            params[key] = np.full(n, val)
+
+    # eruption frequency depends on emplacement duration: the last design dimension is scaled
+    # onto (dt, emp_dur) of each sample
+    params["erup_freq"] = dt + (params["emp_dur"]-dt)*u[:, -1]
+
+    return params
+
 # split the parameter dictionary into parameters for the model vs. x function
 def slice_params(params):
     model_params = {key: params[key] for key in params if key not in ['b','a','T0']} # arguments for model function
@@ -35,9 +93,23 @@ def dict_array(d):
     length = len(list(d.values())[0])
     return[{key:d[key][i] for key in d} for i in range(length)]
 
-# print time in seconds or minutes
-def sec_min_str(time_sec):
-    return f"{int(time_sec // 60)} minutes" if time_sec >= 60 else f"{int(time_sec)} seconds"
+# observed throughput [iters/s] of a benchmark, from the latest record in the benchmark results file
+# (see benchmark.py), or None if it hasn't been run
+def benchmark_rate(benchmark, filename="data/benchmarks.jsonl"):
+    if not os.path.exists(filename):
+        return None
+    return benchmark_rates(filename, os.stat(filename).st_mtime_ns).get(benchmark)
+
+# latest throughput of every benchmark in a results file, read once per modification of the file
+@functools.lru_cache(maxsize=4)
+def benchmark_rates(filename, mtime):
+    rates = {}
+    with open(filename) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                rates[record["benchmark"]] = record["throughput"]
+    return rates
 
 # run the model (not using this function - replaced by parallelized version)
 def run_model_iters(params):
@@ -54,75 +126,1071 @@ def run_model_iters(params):
     return np.array(t),np.array(results)
 
 ### MAIN MC FUNCTIONS ###
-def run_single_iteration(i,model_array,x_array,T0):
-    t, N = run_model(**model_array[i])
-    T = T0[i] + x(N, **x_array[i])
+# run iteration i, indexing into the parameter arrays (no per-iteration dictionaries are built up front)
+def run_single_iteration(i,model_params,x_params,T0,model_fn=run_model):
+    with timed("integrate"):
+        t, N = model_fn(**{key: val[i] for key, val in model_params.items()})
+    with timed("temperature"):
+        T = T0[i] + x(N, **{key: val[i] for key, val in x_params.items()})
     return t, T
 
-def run_model_iters_parallel(params, print_progress=True):
-    # slice the dictionary into model function vs. x function and rearrange
+# take rows start:stop of every parameter
+def slice_rows(d,start,stop):
+    return {key: np.asarray(d[key])[start:stop] for key in d}
+
+# run a contiguous batch of iterations with the vectorized model and return temperatures
+def run_batch_block(model_params,x_params,T0,model_fn=run_model_batch):
+    with timed("integrate"):
+        t, N = model_fn(**model_params)
+    with timed("temperature"):
+        x_batch = {key: np.asarray(val)[:,None] for key,val in x_params.items()} # broadcast over time steps
+        return np.asarray(T0)[:,None] + x(N, **x_batch)
+
+# run a contiguous batch of iterations one at a time with the adaptive time-stepping model
+# (reported on the run_model time grid) and return temperatures; adaptive_kwargs: rtol, atol, method
+def run_adaptive_block(model_params,x_params,T0,**adaptive_kwargs):
+    T = []
+    for i in range(len(T0)):
+        t, N = run_model_adaptive(**{key: val[i] for key, val in model_params.items()}, **adaptive_kwargs)
+        T.append(T0[i] + x(N, **{key: val[i] for key, val in x_params.items()}))
+    return np.array(T)
+
+# agreement of run_model_adaptive with the fixed-step run_model on a sample of the iterations, against
+# run_model_batch at dt/refine (refine=1 for the fixed-step model as used by the MC functions):
+#   "min_temp_error": max difference of the min temperature before max_time [K] (what summary_stats uses)
+#   "pointwise_error": max temperature difference on the run_model grid [K]; this includes eruptions that
+#                      the fixed-step model places on its grid, so it is large right after them
+#   "adaptive_time", "fixed_time": wall times of the two models [s]
+#   "within_tolerance": min_temp_error <= tolerance [K]
+# disagreement that doesn't shrink with rtol/atol comes from the fixed-step model (check with refine > 1)
+def adaptive_agreement(params, tolerance=0.1, sample=64, refine=1, max_time=2.15, seed=0, **adaptive_kwargs):
+    params = as_params(params)
+    iters = len(params['T0'])
+    index = np.sort(np.random.default_rng(seed).choice(iters, min(sample, iters), replace=False))
+    subset = {key: np.asarray(val)[index] for key, val in params.items()}
+    model_params, x_params = slice_params(subset)
+    t = model_time(subset['dt'][0], subset['t_max'][0])
+    late_index = (t >= max_time).argmax()
+
+    start = time.perf_counter()
+    T_adaptive = run_adaptive_block(model_params, x_params, subset['T0'], **adaptive_kwargs)
+    adaptive_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    T_fixed = run_batch_block({**model_params, "dt": model_params["dt"]/refine}, x_params, subset['T0'])
+    fixed_time = time.perf_counter() - start
+    t_fixed = model_time(subset['dt'][0]/refine, subset['t_max'][0])
+
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning) # all-NaN runs
+        min_temp_error = np.nanmax(np.abs(np.nanmin(T_adaptive[:, :late_index], axis=1)
+                                          - np.nanmin(T_fixed[:, t_fixed < t[late_index]], axis=1)))
+        T_fixed = np.array([np.interp(t, t_fixed, row) for row in T_fixed]) if refine != 1 else T_fixed
+        pointwise_error = np.nanmax(np.abs(T_adaptive - T_fixed))
+    return {"min_temp_error": min_temp_error, "pointwise_error": pointwise_error,
+            "adaptive_time": adaptive_time, "fixed_time": fixed_time, "iters": len(index),
+            "within_tolerance": bool(min_temp_error <= tolerance)}
+
+# integrator tolerances for run_model_adaptive that keep min temperatures within tolerance [K] of run_model
+# on a sample: the defaults, or 100 times tighter; raises ValueError if neither is enough
+def adaptive_tolerances(params, tolerance):
+    for adaptive_kwargs in [{"rtol": 1e-6, "atol": 1e-9}, {"rtol": 1e-8, "atol": 1e-11}]:
+        agreement = adaptive_agreement(params, tolerance, **adaptive_kwargs)
+        if agreement["within_tolerance"]:
+            return adaptive_kwargs
+    raise ValueError(f"adaptive min temperatures differ from run_model by up to {agreement['min_temp_error']:.3g} K "
+                     f"(tolerance {tolerance} K) even with rtol={adaptive_kwargs['rtol']}; if this doesn't shrink "
+                     f"with rtol, it is the fixed-step error (see adaptive_agreement with refine > 1)")
+
+# same as run_batch_block (or block_fn), writing temperatures into out[start:]
+def run_batch_into(out,start,model_params,x_params,T0,block_fn=run_batch_block):
+    T = block_fn(model_params,x_params,T0)
+    out[start:start+len(T)] = T
+    return len(T)
+
+# same as run_batch_into, for worker processes writing into a shared memory block
+def run_batch_shared(shm_name,shape,start,model_params,x_params,T0,block_fn=run_batch_block):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        out = np.ndarray(shape, dtype="f8", buffer=shm.buf)
+        completed = run_batch_into(out,start,model_params,x_params,T0,block_fn=block_fn)
+        del out # release the buffer before closing
+    finally:
+        shm.close()
+    return completed
+
+def run_model_iters_parallel(params, print_progress=True,
+                             batch_size=None, # if set, run contiguous batches of iterations with run_model_batch
+                             processes=False, # if True, run batches in worker processes that write into shared memory
+                             workers=None, # number of worker threads/processes (None for the executor default)
+                             on_block=None, # if set, called as on_block(start, T_block) as each batch finishes,
+                                            # instead of collecting all temperatures in memory (raises
+                                            # RuntimeError at the end if any batch or on_block call failed)
+                             adaptive=False, # if True, integrate with run_model_adaptive (in batches of iterations)
+                             adaptive_tolerance=None, # if set, first check on a sample that adaptive min temperatures
+                                                      # agree with run_model within this [K] (adaptive_agreement),
+                                                      # tightening rtol/atol once and raising ValueError if they don't
+                             callbacks=None, # progress callbacks, called with progress events (see instrumentation.py)
+                             cache=False # if True, serve repeated parameter sets from the run cache (see model_cache.py)
+                             ):
+    if cache and adaptive:
+        raise ValueError("the run cache only covers run_model and run_model_batch, not adaptive runs")
+
+    # slice the dictionary (or parameter table) into model function vs. x function
+    params = as_params(params)
     model_params, x_params = slice_params(params)
-    model_array, x_array = dict_array(model_params), dict_array(x_params)
 
     # setup
-    iters = len(model_array)
+    iters = len(params['T0'])
     T0 = params['T0']
+    if (processes or on_block or adaptive) and not batch_size:
+        batch_size = 1000
+    block_fn = run_adaptive_block if adaptive else run_batch_block
+    if adaptive and adaptive_tolerance is not None:
+        block_fn = functools.partial(run_adaptive_block, **adaptive_tolerances(params, adaptive_tolerance))
+    if cache:
+        block_fn = functools.partial(run_batch_block, model_fn=cached_run_model_batch)
+    use_shm = processes and not on_block
 
-    if print_progress:
-        # set up progress tracking
-        if iters < 500:
-            print_interval = 10
-        elif iters < 100000:
-            print_interval = 30
-        else:
-            print_interval = 120
-
-        start_time = time.time()
-        next_print_time = start_time + print_interval
+    callbacks = progress_callbacks(print_progress, callbacks)
+    progress = None
+    if callbacks:
+        mode = "adaptive" if adaptive else "processes" if processes else "batch" if batch_size else "scalar"
+        progress = start_progress(iters, callbacks, rate=benchmark_rate(f"run_model_iters_parallel[{mode}]"))
 
-        est_sec = iters * 10 / 250  # observed about 250 iters every 10 seconds
-        start_time_str = datetime.fromtimestamp(start_time).strftime('%I:%M %p')
-        est_time_str = datetime.fromtimestamp(start_time + est_sec).strftime('%I:%M %p')
-        print(f"Starting {iters:,} iterations at {start_time_str}")
-        print(f"Estimating completion in {sec_min_str(est_sec)} at {est_time_str}")
+    # batched modes write straight into the output array (or hand blocks to on_block), in sample order
+    if batch_size:
+        t = model_time(params['dt'][0], params['t_max'][0])
+        shape = (iters, len(t))
+        if on_block:
+            T = None
+        elif processes:
+            shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape))*8)
+            T = np.ndarray(shape, dtype="f8", buffer=shm.buf)
+        else:
+            T = np.empty(shape)
+        if T is not None:
+            T[:] = np.nan # iterations that fail stay NaN
+    else:
+        model_params = {key: np.asarray(val) for key, val in model_params.items()}
+        x_params = {key: np.asarray(val) for key, val in x_params.items()}
 
     # parallelization
     results = []
-    with concurrent.futures.ThreadPoolExecutor() as executor:
+    completed = 0
+    failed = [] # iteration (or block start) indices that raised
+    pool = concurrent.futures.ProcessPoolExecutor if processes else concurrent.futures.ThreadPoolExecutor
+    try:
+        with timed("executor"), pool(max_workers=workers) as executor:
+            if on_block:
+                futures = {
+                    executor.submit(block_fn,
+                                    slice_rows(model_params, i, i+batch_size), slice_rows(x_params, i, i+batch_size),
+                                    np.asarray(T0)[i:i+batch_size]): i
+                    for i in range(0, iters, batch_size)
+                }
+            elif processes:
+                futures = {
+                    executor.submit(run_batch_shared, shm.name, shape, i,
+                                    slice_rows(model_params, i, i+batch_size), slice_rows(x_params, i, i+batch_size),
+                                    np.asarray(T0)[i:i+batch_size], block_fn): i
+                    for i in range(0, iters, batch_size)
+                }
+            elif batch_size:
+                futures = {
+                    executor.submit(run_batch_into, T, i,
+                                    slice_rows(model_params, i, i+batch_size), slice_rows(x_params, i, i+batch_size),
+                                    np.asarray(T0)[i:i+batch_size], block_fn): i
+                    for i in range(0, iters, batch_size)
+                }
+            else:
+                futures = {
+                    executor.submit(run_single_iteration, i, model_params, x_params, T0,
+                                    cached_run_model if cache else run_model): i
+                    for i in range(iters)
+                }
+            for future in concurrent.futures.as_completed(futures):
+                iteration_index = futures.pop(future) # drop the reference so finished blocks can be freed
+                try:
+                    result = future.result()  # get (t, T), or number of iterations / block in batched modes
+                    if on_block:
+                        on_block(iteration_index, result)
+                        completed += len(result)
+                    elif batch_size:
+                        completed += result
+                    else:
+                        results.append((iteration_index, *result))  # include iteration index to sort later
+                        completed += 1
+
+                    # report progress
+                    if progress:
+                        update_progress(progress, completed)
+
+                except Exception as e:
+                    failed.append(iteration_index)
+                    print(f"Iteration {iteration_index} generated an exception: {e}")
+
+        if use_shm:
+            with timed("collect"):
+                T = T.copy() # move results out of shared memory
+    finally:
+        if use_shm:
+            shm.close()
+            shm.unlink()
+
+    # ending print statements
+    if progress:
+        end_progress(progress)
+
+    # blocks handed to on_block can't be left NaN: a failed batch or on_block call would leave a gap
+    if failed and on_block:
+        raise RuntimeError(f"{len(failed)} blocks failed (starting at iterations "
+                           f"{', '.join(str(i) for i in sorted(failed))})")
+
+    if batch_size:
+        return t, T
+
+    # combine results
+    with timed("collect"):
+        results.sort(key=lambda x: x[0])  # sort by iteration index to preserve order alignment with parameters
+        _, t_all, T_all = zip(*results)
+
+        t = np.array(t_all[0])
+        T = np.array(T_all)
+
+    return t, T
+
+# run a contiguous batch of iterations, reducing each run to summary statistics on the fly
+def run_batch_stats(model_params,x_params,T0,**stats_kwargs):
+    return run_model_batch_stats(T0=T0, b=x_params['b'], a=x_params['a'], **stats_kwargs, **model_params)
+
+# streaming alternative to run_model_iters_parallel + summary_stats: returns the per-iteration
+# statistics summary_stats computes, without storing full trajectories
+# keep_trajectories: number of randomly chosen iterations (or an array of iteration indices)
+#                    for which full temperature trajectories are also returned
+def run_model_iters_stats(params, print_progress=True,
+                          threshold_temp=280, # temperature threshold [K]
+                          min_time=0.9, # min time to snowball [Myr]
+                          max_time=2.15, # max time to snowball [Myr]
+                          early_stop=True, # stop integrating runs after max_time
+                          stop_decided=False, # stop integrating runs that cross the threshold before min_time
+                          keep_trajectories=0,
+                          batch_size=1000,
+                          processes=False, # if True, run batches in worker processes
+                          workers=None, # number of worker threads/processes (None for the executor default)
+                          callbacks=None # progress callbacks, called with progress events (see instrumentation.py)
+                          ):
+    params = as_params(params)
+    model_params, x_params = slice_params(params)
+    iters = len(params['T0'])
+    T0 = params['T0']
+    stats_kwargs = dict(threshold_temp=threshold_temp, min_time=min_time, max_time=max_time,
+                        early_stop=early_stop, stop_decided=stop_decided)
+
+    callbacks = progress_callbacks(print_progress, callbacks)
+    progress = start_progress(iters, callbacks) if callbacks else None
+
+    stats = {}
+    completed = 0
+    pool = concurrent.futures.ProcessPoolExecutor if processes else concurrent.futures.ThreadPoolExecutor
+    with timed("executor"), pool(max_workers=workers) as executor:
         futures = {
-            executor.submit(run_single_iteration, i, model_array, x_array, T0): i
-            for i in range(iters)
+            executor.submit(run_batch_stats,
+                            slice_rows(model_params, i, i+batch_size), slice_rows(x_params, i, i+batch_size),
+                            np.asarray(T0)[i:i+batch_size], **stats_kwargs): i
+            for i in range(0, iters, batch_size)
         }
         for future in concurrent.futures.as_completed(futures):
-            iteration_index = futures[future]
-            try:
-                result = future.result()  # get (t, T)
-                results.append((iteration_index, *result))  # include iteration index to sort later
-
-                # print progress every time interval
-                if print_progress:
-                    current_time = time.time()
-                    if current_time >= next_print_time:
-                        elapsed = current_time - start_time
-                        completed = len(results)
-                        print(f"    Completed {completed:,}/{iters:,} iterations after {sec_min_str(elapsed)}")
-                        next_print_time += print_interval
-                        
-            except Exception as e:
-                print(f"Iteration {iteration_index} generated an exception: {e}")
+            i = futures[future]
+            batch_stats = future.result()
+            for key, val in batch_stats.items():
+                if key not in stats:
+                    stats[key] = np.empty(iters, dtype=val.dtype)
+                stats[key][i:i+len(val)] = val
+            completed += len(batch_stats["min_temp"])
 
-    # ending print statements
+            if progress:
+                update_progress(progress, completed)
+
+    if progress:
+        end_progress(progress)
+
+    for key in ["late_flag", "early_flag", "snowball_flag"]:
+        stats[key] = stats[key].astype("i1")
+
+    if np.isscalar(keep_trajectories) and keep_trajectories == 0:
+        return stats
+
+    # full trajectories for a subset of iterations
+    if np.isscalar(keep_trajectories):
+        sample_index = np.sort(np.random.choice(iters, size=min(keep_trajectories, iters), replace=False))
+    else:
+        sample_index = np.asarray(keep_trajectories)
+    subset = {key: np.asarray(val)[sample_index] for key, val in params.items()}
+    t, T = run_model_iters_parallel(subset, print_progress=False, batch_size=batch_size)
+    return stats, (sample_index, t, T)
+
+# minimum temperatures of run_model over a Cartesian grid of parameters, evaluated in parallel batches
+# coords: {dimension: coordinate values}; a dimension named after a model parameter (e.g. "A0") sweeps
+#         that parameter, other dimensions (e.g. "age", "quantile") only label the grid
+# params: every other model/temperature parameter, either a scalar or (dims, values) for parameters that
+#         vary along some of the dimensions (e.g. N0 by ("quantile","age"), V by "age")
+# returns a labeled result {"dims", "coords", "params", "min_temp", "min_normed_temp"} with the
+# temperatures shaped by dims, ready for save_sweep
+def sweep_grid(coords, params, print_progress=False,
+               batch_size=1000,
+               processes=False, # if True, run batches in worker processes
+               workers=None # number of worker threads/processes (None for the executor default)
+               ):
+    dims = tuple(coords)
+    coords = {dim: np.asarray(val) for dim, val in coords.items()}
+    shape = tuple(len(coords[dim]) for dim in dims)
+    arg_names = [key for key in inspect.signature(run_model).parameters if key != 'prognostics'] + ['T0','b','a']
+
+    # labeled parameters: (dims, values) for every parameter, scalars with no dims
+    grid_params = {dim: (dim, coords[dim]) for dim in dims if dim in arg_names}
+    grid_params.update(params)
+    labeled = {}
+    for key, val in grid_params.items():
+        if key not in arg_names:
+            raise ValueError(f"{key} is not a run_model parameter")
+        param_dims, values = val if isinstance(val, tuple) else ((), val)
+        param_dims = (param_dims,) if isinstance(param_dims, str) else tuple(param_dims)
+        values = np.asarray(values, dtype=float)
+        if values.shape != tuple(len(coords[dim]) for dim in param_dims):
+            raise ValueError(f"shape of {key} {values.shape} does not match its dimensions {param_dims}")
+        labeled[key] = (param_dims, values)
+    missing = [key for key in arg_names if key not in labeled]
+    if missing:
+        raise ValueError(f"missing parameters: {missing}")
+
+    # broadcast every parameter over the full grid and flatten
+    flat = {}
+    for key, (param_dims, values) in labeled.items():
+        order = sorted(param_dims, key=dims.index)
+        values = np.transpose(values, [param_dims.index(dim) for dim in order]) # dims in grid order
+        values = values.reshape([len(coords[dim]) if dim in param_dims else 1 for dim in dims])
+        flat[key] = np.broadcast_to(values, shape).ravel()
+
+    # minimum over the whole run (no max_time window, no early stopping)
+    stats = run_model_iters_stats(flat, print_progress=print_progress, max_time=np.inf, early_stop=False,
+                                  batch_size=batch_size, processes=processes, workers=workers)
+
+    return {"dims": dims, "coords": coords, "params": labeled,
+            "min_temp": stats["min_temp"].reshape(shape),
+            "min_normed_temp": stats["min_normed_temp"].reshape(shape)}
+
+# run the model and write results into a NetCDF file block by block as batches finish,
+# so peak memory is bounded by the batch size; storage keywords are passed to create_data_file
+# timing_report: also write the phase timers of this run into the file attributes (see write_timing_report)
+# profile: number of iterations (or their indices) to profile with cProfile first, reported with the timers
+def run_model_iters_to_file(filename, params, description=None, print_progress=True,
+                            batch_size=1000, processes=False, workers=None, callbacks=None,
+                            timing_report=False, profile=0,
+                            **storage):
+    params = as_params(params)
+    profile_report = profile_iterations(params, profile, batch_size=batch_size) if profile else None
+    if timing_report or profile:
+        reset_phase_timers() # time the run itself
+    t = model_time(params['dt'][0], params['t_max'][0])
+    with create_data_file(filename, t, params, description=description, **storage) as ncfile:
+        run_model_iters_parallel(params, print_progress=print_progress,
+                                 batch_size=batch_size, processes=processes, workers=workers, callbacks=callbacks,
+                                 on_block=lambda start, T: write_block(ncfile, start, T))
+    if timing_report or profile:
+        write_timing_report(filename, profile=profile_report)
+    print(f"Data saved to {filename}")
+    return t
+
+# profile a subset of iterations with cProfile (in this thread), returning the pstats report as text
+# iterations: number of iterations, spread evenly through the run, or an array of iteration indices
+def profile_iterations(params, iterations=100, batch_size=None, sort="cumulative", limit=30):
+    params = as_params(params)
+    iters = len(params['T0'])
+    if np.isscalar(iterations):
+        index = np.unique(np.linspace(0, iters-1, min(iterations, iters)).astype(int))
+    else:
+        index = np.asarray(iterations)
+    subset = {key: np.asarray(val)[index] for key, val in params.items()}
+    model_params, x_params = slice_params(subset)
+    if batch_size:
+        run = lambda: run_batch_block(model_params, x_params, subset['T0'])
+    else:
+        run = lambda: [run_single_iteration(i, model_params, x_params, subset['T0']) for i in range(len(index))]
+    _, report = profile_call(run, sort=sort, limit=limit)
+    return f"Profile of {len(index)} iterations\n" + report
+
+# screening stage in front of run_model_iters_parallel: runs predicted by a surrogate (see screen_params)
+# to stay clearly above threshold_temp are not integrated; their temperatures are left NaN
+# returns t, T and the screened flags and predicted min temperatures, to be saved with write_screening
+def run_model_iters_screened(params, surrogate=None,
+                             threshold_temp=280, # temperature threshold [K]
+                             max_time=2.15, # max time to snowball [Myr]
+                             margin=None, # screening margin above threshold_temp [K] (None for the surrogate's)
+                             print_progress=True, batch_size=1000, **parallel_kwargs):
+    params = as_params(params)
+    iters = len(params['T0'])
+    screened, predicted = screen_params(params, surrogate, threshold_temp=threshold_temp, margin=margin,
+                                        max_time=max_time)
+    run = np.flatnonzero(~screened)
     if print_progress:
-        current_time = time.time()
-        elapsed = current_time - start_time
-        end_time_str = datetime.fromtimestamp(current_time).strftime('%I:%M %p')
-        print(f"Completed {iters:,} iterations after {sec_min_str(elapsed)} at {end_time_str}")
+        print(f"Screened out {screened.sum()} of {iters} runs, running {len(run)}")
 
-    # combine results
-    results.sort(key=lambda x: x[0])  # sort by iteration index to preserve order alignment with parameters
-    _, t_all, T_all = zip(*results)
+    t = model_time(params['dt'][0], params['t_max'][0])
+    T = np.full((iters, len(t)), np.nan)
+    if len(run):
+        subset = {key: np.asarray(val)[run] for key, val in params.items()}
+        _, T[run] = run_model_iters_parallel(subset, print_progress=print_progress, batch_size=batch_size,
+                                             **parallel_kwargs)
+    return t, T, screened, predicted
+
+### SEQUENTIAL MONTE CARLO ###
+# running estimates of the summary_stats percentages and mean cooling, with confidence intervals
+# (Wilson score intervals for the percentages, normal intervals for the mean cooling)
+def snowball_estimates(min_normed_temp,late_condition,early_condition,confidence=0.95):
+    z = st.norm.ppf(0.5 + confidence/2)
+    late_condition = np.asarray(late_condition, dtype=bool)
+    early_condition = np.asarray(early_condition, dtype=bool)
+    n = len(late_condition)
+    estimates = {}
+    for name, condition in [("late_flag_percentage", late_condition),
+                            ("early_flag_percentage", early_condition),
+                            ("snowball_flag_percentage", late_condition & ~early_condition)]:
+        p = condition.mean()
+        center = (p + z**2/(2*n)) / (1 + z**2/n)
+        halfwidth = z*np.sqrt(p*(1-p)/n + z**2/(4*n**2)) / (1 + z**2/n)
+        estimates[name] = (p*100, (center-halfwidth)*100, (center+halfwidth)*100) # estimate, lower, upper [%]
+    cooling = np.asarray(min_normed_temp)[~np.isnan(min_normed_temp)]
+    mean = cooling.mean()
+    halfwidth = z*cooling.std(ddof=1)/np.sqrt(len(cooling)) if len(cooling) > 1 else np.inf
+    estimates["mean_cooling"] = (mean, mean-halfwidth, mean+halfwidth) # [K]
+    return estimates
+
+# generate and save MC runs in batches until the snowball/early/late percentages are known to within
+# target_halfwidth (and the mean cooling to within cooling_halfwidth, if set), or max_iters is spent
+# background: function of the number of iterations returning N0, V, T0 arrays
+#             (e.g. lambda iters: background_ranges(t_Earth, iters))
+# method/seed: passed to sample_params; seeded designs continue across batches
+# writes the same file as save_data + summary_stats (without normed_temp), plus the confidence intervals
+# reached; storage keywords are passed to create_data_file
+def run_model_iters_sequential(filename, param_ranges, dt, t_max, background,
+                               target_halfwidth=1.0, # half width of the percentage confidence intervals [%]
+                               cooling_halfwidth=None, # half width of the mean cooling confidence interval [K]
+                               confidence=0.95,
+                               batch_iters=1000, # iterations per batch (and per stopping check)
+                               min_iters=1000, max_iters=100_000,
+                               method=None, seed=None,
+                               threshold_temp=280, # temperature threshold [K]
+                               min_time=0.9, # min time to snowball [Myr]
+                               max_time=2.15, # max time to snowball [Myr]
+                               description=None, print_progress=True,
+                               batch_size=1000, processes=False, workers=None,
+                               **storage):
+    if method is not None and seed is None:
+        seed = np.random.SeedSequence().entropy # every batch has to share one seed
+    stats = {"min_temp": [], "min_normed_temp": [], "late_condition": [], "early_condition": []}
+    targets = {"late_flag_percentage": target_halfwidth,
+               "early_flag_percentage": target_halfwidth,
+               "snowball_flag_percentage": target_halfwidth,
+               "mean_cooling": cooling_halfwidth}
+    ncfile = None
+    completed = 0
+    start_time = time.time()
+    try:
+        while completed < max_iters:
+            # sample a batch and add background climate
+            n = min(batch_iters, max_iters-completed)
+            if method is None:
+                params = sample_params(n, param_ranges, dt, t_max)
+            else:
+                params = sample_params_chunk(n, param_ranges, dt, t_max, method=method, seed=seed,
+                                             chunk=completed//batch_iters, chunk_size=batch_iters)
+            params['N0'], params['V'], params['T0'] = background(n)
+
+            # run and append to the file
+            t, T = run_model_iters_parallel(params, print_progress=False, batch_size=batch_size,
+                                            processes=processes, workers=workers)
+            if ncfile is None:
+                ncfile = create_data_file(filename, t, params, description=description, unlimited=True, **storage)
+            else:
+                write_param_block(ncfile, completed, params)
+            write_block(ncfile, completed, T)
+            completed += n
+
+            # update the running estimates
+            batch_stats = trajectory_stats(T, T - T[:, :1], (t >= min_time).argmax(), (t >= max_time).argmax(),
+                                           threshold_temp)
+            for key, val in zip(stats, batch_stats):
+                stats[key].append(val)
+            estimates = snowball_estimates(np.concatenate(stats["min_normed_temp"]),
+                                           np.concatenate(stats["late_condition"]),
+                                           np.concatenate(stats["early_condition"]), confidence)
+            halfwidths = {key: (upper-lower)/2 for key, (_, lower, upper) in estimates.items()}
+            converged = all(target is None or halfwidths[key] <= target for key, target in targets.items())
+
+            if print_progress:
+                print(f"{completed} iters ({sec_min_str(time.time()-start_time)}): "
+                      f"snowball {estimates['snowball_flag_percentage'][0]:.2f} "
+                      f"± {halfwidths['snowball_flag_percentage']:.2f}%, "
+                      f"cooling {estimates['mean_cooling'][0]:.2f} ± {halfwidths['mean_cooling']:.2f} K")
+            if converged and completed >= min_iters:
+                break
+
+        # statistics and the precision reached
+        stats = {key: np.concatenate(val) for key, val in stats.items()}
+        stats_group = ncfile.createGroup("stats")
+        write_stats(stats_group, **stats, threshold_temp=threshold_temp, min_time=min_time, max_time=max_time,
+                    print_progress=print_progress)
+        stats_group.confidence = confidence
+        stats_group.target_halfwidth = target_halfwidth
+        if cooling_halfwidth is not None:
+            stats_group.cooling_halfwidth = cooling_halfwidth
+        stats_group.converged = int(converged)
+        cooling_var = stats_group.createVariable("mean_cooling", "f8") # percentages are already written
+        cooling_var[:] = estimates["mean_cooling"][0]
+        cooling_var.long_name = "Mean of min normalized temp"
+        cooling_var.units = "K"
+        for key, (_, lower, upper) in estimates.items():
+            units = "K" if key == "mean_cooling" else "%"
+            for bound, val in [("lower", lower), ("upper", upper)]:
+                bound_var = stats_group.createVariable(f"{key}_{bound}", "f8")
+                bound_var[:] = val
+                bound_var.long_name = f"{bound.capitalize()} bound of the {confidence:.0%} confidence interval for {key.replace('_', ' ')}"
+                bound_var.units = units
+    finally:
+        if ncfile is not None:
+            ncfile.close()
+
+    if print_progress:
+        status = "converged" if converged else "stopped at max_iters"
+        print(f"{status} after {completed} iters")
+    print(f"Data saved to {filename}")
+    return completed
+
+### CHECKPOINTING ###
+# write an array atomically, so an interrupted run never leaves a partial block behind
+def save_array_atomic(filename,arr):
+    tmp = filename + ".tmp"
+    with open(tmp, "wb") as f:
+        np.save(f, arr)
+    os.replace(tmp, filename)
+
+# run the model with checkpointing: the sampled parameters and every finished block of results are
+# persisted under checkpoint_dir/run_id as the run goes, and re-running with the same run_id
+# (e.g. after the kernel died) loads the stored parameters and only computes the missing blocks
+# if filename is given, results are written block by block into a NetCDF file (storage keywords are
+# passed to create_data_file) and T is returned as None
+def run_model_iters_checkpoint(params, run_id,
+                               checkpoint_dir="data/checkpoints",
+                               batch_size=1000,
+                               print_progress=True,
+                               processes=False, workers=None,
+                               filename=None, description=None,
+                               **storage):
+    params = as_params(params)
+    path = os.path.join(checkpoint_dir, run_id)
+    params_file = os.path.join(path, "params.npz")
+    meta_file = os.path.join(path, "run.json")
+
+    if os.path.exists(params_file):
+        # resume: the stored parameters and block size take precedence
+        with np.load(params_file) as f:
+            params = {key: f[key] for key in f.files}
+        if os.path.exists(meta_file): # missing only for runs set up before run.json was written first
+            with open(meta_file) as f:
+                batch_size = json.load(f)["batch_size"]
+    else:
+        # run.json first and both atomically: params.npz marks a complete setup
+        os.makedirs(path, exist_ok=True)
+        tmp = meta_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"run_id": run_id, "iters": len(params['T0']), "batch_size": batch_size}, f)
+        os.replace(tmp, meta_file)
+        tmp = params_file + ".tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, **{key: np.asarray(val) for key, val in params.items()})
+        os.replace(tmp, params_file)
+
+    iters = len(params['T0'])
+    block_file = lambda start: os.path.join(path, f"block_{start}.npy")
+    starts = list(range(0, iters, batch_size))
+    missing = [start for start in starts if not os.path.exists(block_file(start))]
+
+    if print_progress and len(missing) < len(starts):
+        print(f"Resuming run {run_id}: {len(starts)-len(missing):,}/{len(starts):,} blocks already complete")
+
+    # run only the missing blocks; they keep the same boundaries inside the reduced parameter set
+    if missing:
+        rows = np.concatenate([np.arange(start, min(start+batch_size, iters)) for start in missing])
+        todo = {key: np.asarray(val)[rows] for key, val in params.items()}
+        def save_block(start, T_block):
+            save_array_atomic(block_file(missing[start//batch_size]), T_block)
+        try:
+            run_model_iters_parallel(todo, print_progress=print_progress, batch_size=batch_size,
+                                     processes=processes, workers=workers, on_block=save_block)
+        except RuntimeError: # failed blocks are reported below
+            pass
+
+    missing = [start for start in starts if not os.path.exists(block_file(start))]
+    if missing:
+        raise RuntimeError(f"{len(missing)} blocks of run {run_id} failed; re-run with the same run_id to retry them")
+
+    # combine blocks in sample order
+    t = model_time(params['dt'][0], params['t_max'][0])
+    if filename:
+        with create_data_file(filename, t, params, description=description, **storage) as ncfile:
+            for start in starts:
+                write_block(ncfile, start, np.load(block_file(start)))
+        print(f"Data saved to {filename}")
+        return t, None, params
+
+    T = np.empty((iters, len(t)))
+    for start in starts:
+        T[start:start+batch_size] = np.load(block_file(start))
+    return t, T, params
+
+### CRITICAL PARAMETERS ###
+# for each parameter set, find the value of one parameter (key) at which a threshold flag
+# ("late_flag" or "early_flag", as in summary_stats) switches, by batched bisection within bounds
+# returns {"critical", "flag_low", "flag_high"}: the critical values (NaN where the flag is the same at
+# both bounds) and the flags at the lower and upper bounds
+# the flag is assumed to switch at most once within the bounds (otherwise one of the switches is found);
+# bisection stops once each bracket is narrower than rtol relative to its values, or after as many steps
+# as it takes to narrow the bounds to rtol of their magnitude (log: rtol in ratio)
+def critical_values(params, key, bounds, flag="late_flag",
+                    log=False, # bisect in log space (for parameters spanning orders of magnitude)
+                    rtol=1e-3, # relative width of the final bracket
+                    threshold_temp=280, # temperature threshold [K]
+                    min_time=0.9, # min time to snowball [Myr]
+                    max_time=2.15, # max time to snowball [Myr]
+                    print_progress=True,
+                    batch_size=1000, processes=False, workers=None):
+    if log and not bounds[0] > 0:
+        raise ValueError(f"log bisection needs a positive lower bound, got {bounds[0]}")
+    params = {k: np.asarray(val) for k, val in as_params(params).items()}
+    iters = len(params['T0'])
+
+    # flags for a subset of runs with the parameter set to values
+    def flags_at(idx, values):
+        subset = {k: val[idx] for k, val in params.items()}
+        subset[key] = values
+        stats = run_model_iters_stats(subset, print_progress=False,
+                                      threshold_temp=threshold_temp, min_time=min_time, max_time=max_time,
+                                      stop_decided=True, # late_flag is set whenever early_flag is
+                                      batch_size=batch_size, processes=processes, workers=workers)
+        return stats[flag].astype(bool)
+
+    # bracket
+    all_idx = np.arange(iters)
+    low, high = np.full(iters, float(bounds[0])), np.full(iters, float(bounds[1]))
+    flag_low, flag_high = flags_at(all_idx, low), flags_at(all_idx, high)
+    idx = np.flatnonzero(flag_low != flag_high) # runs with a switch inside the bounds
+
+    # bisect, keeping the flag at low equal to flag_low
+    if log:
+        max_steps = int(np.ceil(np.log2(np.log(bounds[1]/bounds[0])/np.log1p(rtol)))) + 1
+    else:
+        max_steps = int(np.ceil(np.log2((bounds[1] - bounds[0])/(rtol*max(abs(bounds[0]), abs(bounds[1])))))) + 1
+    steps = 0
+    while len(idx) and steps < max(max_steps, 1):
+        mid = np.sqrt(low[idx]*high[idx]) if log else (low[idx] + high[idx])/2
+        same = flags_at(idx, mid) == flag_low[idx]
+        low[idx[same]] = mid[same]
+        high[idx[~same]] = mid[~same]
+        idx = idx[high[idx] - low[idx] > rtol*np.maximum(np.abs(low[idx]), np.abs(high[idx]))]
+        steps += 1
+        if print_progress:
+            print(f"Bisection step {steps}: {len(idx)} runs left")
+
+    critical = np.where(flag_low != flag_high, (low + high)/2, np.nan)
+    return {"critical": critical, "flag_low": flag_low, "flag_high": flag_high}
+
+# critical values for both flags that make up the snowball criterion (late and not early)
+def critical_snowball(params, key, bounds, **kwargs):
+    return {flag: critical_values(params, key, bounds, flag=flag, **kwargs) for flag in ["late_flag", "early_flag"]}
+
+# flags for parameter value(s) within the bounds, answered from stored critical values
+def classify_flag(value, critical):
+    above = np.asarray(value) >= critical["critical"]
+    flag = np.where(critical["flag_high"], above, ~above) # the flag at high holds above the switch
+    return np.where(np.isnan(critical["critical"]), critical["flag_low"], flag)
+
+# snowball flags for parameter value(s) within the bounds, without new simulations
+def classify_snowball(value, critical):
+    return classify_flag(value, critical["late_flag"]) & ~classify_flag(value, critical["early_flag"])
+
+### ADAPTIVE IMPORTANCE SAMPLING ###
+# features for the outcome classifiers: linear and quadratic terms of the unit hypercube coordinates
+def quadratic_features(u):
+    return np.hstack([np.ones((len(u), 1)), u, u**2])
+
+# ridge-regularized logistic regression by Newton iterations, returning the coefficients
+def fit_logistic(features, y, ridge=1e-3, steps=25):
+    coef = np.zeros(features.shape[1])
+    for _ in range(steps):
+        prob = 1/(1 + np.exp(-features @ coef))
+        grad = features.T @ (prob - y) + ridge*coef
+        hess = (features * (prob*(1-prob))[:, None]).T @ features + ridge*np.eye(len(coef))
+        coef -= np.linalg.solve(hess, grad)
+    return coef
+
+# proposal density on the unit hypercube of sample_params_chunk, learned from previous runs:
+# a defensive share of uniform draws plus draws in proportion to the expected |snowball flag - snowball rate|,
+# which puts runs where the outcome is uncertain or rare (the variance-minimizing density for the percentage)
+def outcome_proposal(u, late_condition, early_condition, defensive=0.3, rng=None, norm_samples=100_000):
+    rng = np.random.default_rng(rng)
+    features = quadratic_features(u)
+    snowball_rate = np.mean(late_condition & ~early_condition)
+    proposal = {"late": fit_logistic(features, late_condition.astype(float)),
+                "early": fit_logistic(features, early_condition.astype(float)),
+                "rate": snowball_rate, "defensive": defensive,
+                "max": max(snowball_rate, 1-snowball_rate), "norm": 1.0}
+    proposal["norm"] = outcome_score(proposal, rng.random((norm_samples, u.shape[1]))).mean()
+    return proposal
+
+# unnormalized proposal score: expected |snowball flag - snowball rate| under the fitted classifiers
+def outcome_score(proposal, u):
+    features = quadratic_features(u)
+    late = 1/(1 + np.exp(-features @ proposal["late"]))
+    early = 1/(1 + np.exp(-features @ proposal["early"]))
+    snowball = np.clip(late - early, 0, 1) # early runs are a subset of late runs
+    return snowball*(1 - proposal["rate"]) + (1 - snowball)*proposal["rate"]
+
+# draw n points from a proposal (uniform for proposal=None), by rejection from uniform draws
+def proposal_sample(proposal, n, dims, rng):
+    u = rng.random((n, dims))
+    if proposal is None:
+        return u
+    scored = rng.random(n) >= proposal["defensive"]
+    accepted = []
+    while sum(map(len, accepted)) < scored.sum():
+        candidates = rng.random((4*n, dims))
+        keep = rng.random(len(candidates)) * proposal["max"] < outcome_score(proposal, candidates)
+        accepted.append(candidates[keep])
+    u[scored] = np.concatenate(accepted)[:scored.sum()]
+    return u
+
+# proposal density at points u (the sampling density of sample_params is 1 on the cube)
+def proposal_density(proposal, u):
+    if proposal is None:
+        return np.ones(len(u))
+    return proposal["defensive"] + (1-proposal["defensive"]) * outcome_score(proposal, u)/proposal["norm"]
+
+# generate and save MC runs in rounds: a uniform pilot round, then rounds drawn from a proposal
+# concentrated where the outcome flips or is rare, learned from all previous rounds
+# every run carries the importance weight 1/q(u) of its round's proposal, saved as the "weight"
+# variable and used for the weighted percentages in the stats group (also by summary_stats)
+# background: function of the number of iterations returning N0, V, T0 arrays
+def run_model_iters_adaptive(filename, param_ranges, dt, t_max, background,
+                             iters=10_000, # total number of runs
+                             pilot_iters=2000, # uniform runs in the first round
+                             rounds=4, # rounds after the pilot
+                             defensive=0.3, # share of uniform draws in later rounds (caps weights at 1/defensive)
+                             seed=None,
+                             threshold_temp=280, # temperature threshold [K]
+                             min_time=0.9, # min time to snowball [Myr]
+                             max_time=2.15, # max time to snowball [Myr]
+                             description=None, print_progress=True,
+                             batch_size=1000, processes=False, workers=None,
+                             **storage):
+    ranged = [key for key,val in param_ranges.items() if isinstance(val,tuple)]
+    dims = len(ranged) + 1 # last dimension: erup_freq within (dt, emp_dur)
+    sizes = [min(pilot_iters, iters)] + [len(chunk) for chunk in np.array_split(np.arange(iters-pilot_iters), rounds)
+                                         if len(chunk)]
+    proposal = None
+    u_all, stats = [], {"min_temp": [], "min_normed_temp": [], "late_condition": [],
+                                         "early_condition": [], "weights": []}
+    ncfile = None
+    completed = 0
+    try:
+        for r, n in enumerate(sizes):
+            rng = chunk_rng(seed, r)
+            if r:
+                proposal = outcome_proposal(np.concatenate(u_all), np.concatenate(stats["late_condition"]),
+                                            np.concatenate(stats["early_condition"]), defensive=defensive, rng=rng)
+            u = proposal_sample(proposal, n, dims, rng)
+            weights = 1/proposal_density(proposal, u)
+
+            # scale onto the ranges as sample_params_chunk and add background climate
+            params = {'dt': np.full(n, dt), 't_max': np.full(n, t_max)}
+            for key,val in param_ranges.items():
+                if isinstance(val,tuple):
+                    params[key] = val[0] + (val[1]-val[0])*u[:, ranged.index(key)]
+                else:
+                    params[key] = np.full(n, val)
+            params["erup_freq"] = dt + (params["emp_dur"]-dt)*u[:, -1]
+            params['N0'], params['V'], params['T0'] = background(n)
+
+            # run and append to the file
+            t, T = run_model_iters_parallel(params, print_progress=False, batch_size=batch_size,
+                                            processes=processes, workers=workers)
+            if ncfile is None:
+                ncfile = create_data_file(filename, t, params, description=description, unlimited=True, **storage)
+                weight_var = ncfile.createVariable("weight", "f8", ("iterations",))
+                weight_var.long_name = "Importance weight (sampled density / proposal density)"
+                weight_var.units = "dimensionless"
+            else:
+                write_param_block(ncfile, completed, params)
+            write_block(ncfile, completed, T)
+            weight_var[completed:completed+n] = weights
+            completed += n
+
+            # outcomes for the next proposal
+            batch_stats = trajectory_stats(T, T - T[:, :1], (t >= min_time).argmax(), (t >= max_time).argmax(),
+                                           threshold_temp)
+            for key, val in zip(stats, (*batch_stats, weights)):
+                stats[key].append(val)
+            u_all.append(u)
+
+            if print_progress:
+                w = np.concatenate(stats["weights"])
+                snowball = np.concatenate(stats["late_condition"]) & ~np.concatenate(stats["early_condition"])
+                print(f"Round {r}: {completed} iters, "
+                      f"snowball {weighted_nanmean(snowball, w)*100:.2f}%, "
+                      f"effective sample size {w.sum()**2/np.sum(w**2):.0f}")
+
+        stats = {key: np.concatenate(val) for key, val in stats.items()}
+        write_stats(ncfile.createGroup("stats"), **stats, threshold_temp=threshold_temp, min_time=min_time,
+                    max_time=max_time, print_progress=print_progress)
+    finally:
+        if ncfile is not None:
+            ncfile.close()
+
+    print(f"Data saved to {filename}")
+    return completed
+
+### SHARDED RUNS ###
+# a sharded run lives in a run directory on a filesystem shared by all workers:
+#   manifest.json: run settings (iterations, shard size, parameter names, storage keywords, ...)
+#   params.npy: sampled parameters, one contiguous float64 row per parameter (memory-mapped by workers)
+#   claims/shard_<i>.claim: created exclusively by the worker that claims shard i
+#   shards/shard_<i>.nc: temperatures and parameters of shard i, renamed into place once complete
+# workers (local processes or other nodes) claim shards without locks: creating a claim file with O_EXCL
+# succeeds for exactly one worker; merge_shards then combines the shards into one NetCDF file
+
+def shard_file(run_dir, shard):
+    return os.path.join(run_dir, "shards", f"shard_{shard:05d}.nc")
+
+def claim_file(run_dir, shard):
+    return os.path.join(run_dir, "claims", f"shard_{shard:05d}.claim")
+
+# write the manifest and sampled parameters of a sharded run, once; an existing run directory is reused
+# (its stored manifest and parameters take precedence), so every node can call this safely
+def create_sharded_run(run_dir, params, shard_size=10_000, description=None, **storage):
+    manifest_file = os.path.join(run_dir, "manifest.json")
+    if os.path.exists(manifest_file):
+        return read_manifest(run_dir)
+
+    params = as_params(params)
+    keys = list(params)
+    iters = len(params['T0'])
+    os.makedirs(os.path.join(run_dir, "claims"), exist_ok=True)
+    os.makedirs(os.path.join(run_dir, "shards"), exist_ok=True)
+    save_array_atomic(os.path.join(run_dir, "params.npy"),
+                      np.stack([np.asarray(params[key], dtype=float) for key in keys]))
+    manifest = {"iters": iters, "shard_size": shard_size, "shards": (iters + shard_size - 1) // shard_size,
+                "keys": keys, "description": description, "storage": storage,
+                "created": datetime.now().isoformat(timespec="seconds")}
+    tmp = manifest_file + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, manifest_file) # workers only start once the manifest exists
+    return manifest
+
+def read_manifest(run_dir):
+    with open(os.path.join(run_dir, "manifest.json")) as f:
+        return json.load(f)
+
+# parameters of iterations start:stop of a sharded run
+def read_shard_params(run_dir, manifest, start, stop):
+    values = np.load(os.path.join(run_dir, "params.npy"), mmap_mode="r")
+    return {key: np.array(values[i, start:stop]) for i, key in enumerate(manifest["keys"])}
+
+# claim the next shard that is neither complete nor claimed, or None if there are none left
+# claim_timeout: seconds without a heartbeat (the claim is touched after every block) after which an
+# unfinished claim (e.g. of a worker that died) may be taken over; should exceed the time of one block
+def claim_shard(run_dir, manifest, worker, claim_timeout=None):
+    for shard in range(manifest["shards"]):
+        if os.path.exists(shard_file(run_dir, shard)):
+            continue
+        claim = claim_file(run_dir, shard)
+        if claim_timeout is not None and os.path.exists(claim):
+            try:
+                if time.time() - os.path.getmtime(claim) > claim_timeout:
+                    # only one worker can rename the stale claim away, the others see it vanish
+                    os.rename(claim, f"{claim}.stale.{worker}")
+            except FileNotFoundError:
+                pass
+        try:
+            fd = os.open(claim, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            continue
+        with os.fdopen(fd, "w") as f:
+            f.write(json.dumps({"worker": worker, "time": time.time()}))
+        return shard
+    return None
+
+# run one shard into its shard file (written under a temporary name, then renamed once every block is
+# written); the claim file is touched after each block, so other workers don't take over a long shard
+def run_shard(run_dir, manifest, shard, worker, batch_size=1000, processes=False, workers=None):
+    start = shard*manifest["shard_size"]
+    stop = min(start + manifest["shard_size"], manifest["iters"])
+    params = read_shard_params(run_dir, manifest, start, stop)
+    t = model_time(params['dt'][0], params['t_max'][0])
+    filename = shard_file(run_dir, shard)
+    tmp = f"{filename}.{worker}.tmp" # worker ids include the host name, unlike pids
+    storage = {**manifest["storage"], "zlib": False, "chunk_iters": None} # shards are only read once
+    written = []
+
+    def save_block(i, T):
+        write_block(ncfile, i, T)
+        written.append(len(T))
+        try:
+            os.utime(claim_file(run_dir, shard)) # heartbeat for claim_timeout
+        except FileNotFoundError: # taken over as stale: finish anyway, both runs write the same results
+            pass
+
+    try:
+        with create_data_file(tmp, t, params, **storage) as ncfile:
+            run_model_iters_parallel(params, print_progress=False, batch_size=batch_size,
+                                     processes=processes, workers=workers, on_block=save_block)
+        if sum(written) != stop - start:
+            raise RuntimeError(f"shard {shard}: {sum(written)} of {stop - start} iterations written")
+        os.replace(tmp, filename)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+# claim and run shards until none are left; returns the shards this worker ran
+def run_shard_worker(run_dir, worker=None, batch_size=1000, processes=False, workers=None,
+                     claim_timeout=None, print_progress=True):
+    worker = worker or f"{platform.node()}-{os.getpid()}"
+    manifest = read_manifest(run_dir)
+    done = []
+    while True:
+        shard = claim_shard(run_dir, manifest, worker, claim_timeout)
+        if shard is None:
+            break
+        start_time = time.time()
+        run_shard(run_dir, manifest, shard, worker, batch_size=batch_size, processes=processes, workers=workers)
+        done.append(shard)
+        if print_progress:
+            print(f"Worker {worker} completed shard {shard+1}/{manifest['shards']} "
+                  f"in {sec_min_str(time.time() - start_time)}")
+    return done
+
+# number of complete, claimed (running or abandoned) and pending shards
+def shard_status(run_dir):
+    manifest = read_manifest(run_dir)
+    complete = [shard for shard in range(manifest["shards"]) if os.path.exists(shard_file(run_dir, shard))]
+    claimed = [shard for shard in range(manifest["shards"])
+               if shard not in complete and os.path.exists(claim_file(run_dir, shard))]
+    return {"shards": manifest["shards"], "complete": len(complete), "claimed": len(claimed),
+            "pending": manifest["shards"] - len(complete) - len(claimed)}
+
+# run a sharded run with local worker processes (each running run_shard_worker on its own shards)
+def run_sharded_local(run_dir, processes=None, batch_size=1000, claim_timeout=None, print_progress=True):
+    processes = processes or os.cpu_count()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(run_shard_worker, run_dir, f"{platform.node()}-local{i}",
+                                   batch_size=batch_size, claim_timeout=claim_timeout,
+                                   print_progress=print_progress)
+                   for i in range(processes)]
+        return [future.result() for future in futures]
+
+# merge the shards of a complete sharded run into one NetCDF file with the layout of save_data
+# (time, temperature and params), then add the stats group with summary_stats if stats
+def merge_shards(run_dir, filename, stats=True, print_progress=True, **stats_kwargs):
+    manifest = read_manifest(run_dir)
+    missing = [shard for shard in range(manifest["shards"]) if not os.path.exists(shard_file(run_dir, shard))]
+    if missing:
+        raise RuntimeError(f"{len(missing)} of {manifest['shards']} shards are not complete (first: {missing[0]})")
+
+    params = read_shard_params(run_dir, manifest, 0, manifest["iters"])
+    t = model_time(params['dt'][0], params['t_max'][0])
+    with create_data_file(filename, t, params, description=manifest["description"],
+                          **manifest["storage"]) as ncfile:
+        for shard in range(manifest["shards"]):
+            with netCDF4.Dataset(shard_file(run_dir, shard), "r") as shard_ncfile:
+                T = np.ma.filled(shard_ncfile.variables["temperature"][:], np.nan)
+            write_block(ncfile, shard*manifest["shard_size"], T)
+    print(f"Data saved to {filename}")
+
+    if stats:
+        summary_stats(filename, print_progress=print_progress, **stats_kwargs)
+
+### INTERACTIVE ENSEMBLES ###
+# ensembles around a single parameter setting (e.g. the sliders of slider_model.py), run in batches in a
+# background thread so percentile bands and the snowball probability can be shown as they refine
+
+# draw an ensemble around one parameter setting (a dict of run_model arguments plus T0, b and a)
+# background: the background_fits spread (CO2 lognormal, V and T0 normal), shifted onto the setting
+# spread: LIP and weathering parameters are drawn uniformly within +/- spread times their range around
+#         the setting, clipped to the range
+def sample_ensemble(setting, iters, t_Earth, spread=0.1, seed=None, param_ranges=param_ranges):
+    rng = np.random.default_rng(seed)
+    CO2_fit, T_fit, V_fit = background_fits(t_Earth)
+    params = {key: np.full(iters, float(val)) for key, val in setting.items()}
+
+    # background climate: fitted spread around the setting
+    CO2 = st.lognorm.rvs(*CO2_fit, size=iters, random_state=rng)
+    params["N0"] = setting["N0"]*np.sqrt(CO2/st.lognorm.median(*CO2_fit)) # pCO2 scales with N0^2
+    params["V"] = setting["V"] + st.norm.rvs(0, V_fit[1], size=iters, random_state=rng)
+    params["T0"] = setting["T0"] + st.norm.rvs(0, T_fit[1], size=iters, random_state=rng)
+
+    # LIP characteristics: uniform around the setting
+    for key, val in param_ranges.items():
+        if isinstance(val, tuple) and key in setting and key not in ["b"]:
+            low, high = val
+            width = spread*(high - low)
+            params[key] = np.clip(setting[key] + rng.uniform(-width, width, iters), low, high)
+    params["erup_freq"] = np.clip(params["erup_freq"], setting["dt"], params["emp_dur"])
+    return params
+
+# start running an ensemble in a background thread, batch_size runs at a time (through the run cache)
+# returns a job dict; results accumulate in job["T"] (a list of blocks) until done or cancelled
+def start_ensemble(params, batch_size=100):
+    job = {"iters": len(params["T0"]), "t": None, "T": [], "completed": 0, "error": None,
+           "cancel": threading.Event(), "done": threading.Event(), "lock": threading.Lock()}
+
+    def run():
+        try:
+            model_params, x_params = slice_params(params)
+            for start in range(0, job["iters"], batch_size):
+                if job["cancel"].is_set():
+                    return
+                t, N = cached_run_model_batch(**slice_rows(model_params, start, start+batch_size))
+                x_batch = {key: val[start:start+batch_size, None] for key, val in x_params.items()}
+                T = params["T0"][start:start+batch_size, None] + x(N, **x_batch)
+                with job["lock"]:
+                    job["t"] = t[0]
+                    job["T"].append(T)
+                    job["completed"] += len(T)
+        except Exception as e: # shown by the caller
+            job["error"] = e
+        finally:
+            job["done"].set()
+
+    job["thread"] = threading.Thread(target=run, daemon=True)
+    job["thread"].start()
+    return job
 
-    t = np.array(t_all[0])
-    T = np.array(T_all)
+# stop a running ensemble after its current batch
+def cancel_ensemble(job):
+    job["cancel"].set()
 
-    return t, T
\ No newline at end of file
+# percentile bands of the temperature and snowball probability estimates (see snowball_estimates)
+# from the runs of an ensemble finished so far; None before the first batch
+def ensemble_bands(job, percentiles=(2.5, 25, 50, 75, 97.5), threshold_temp=280, min_time=0.9, max_time=2.15,
+                   confidence=0.95):
+    with job["lock"]:
+        if not job["T"]:
+            return None
+        t, T = job["t"], np.concatenate(job["T"])
+    bands = np.nanpercentile(T, percentiles, axis=0)
+    early_index = (t >= min_time).argmax() if t[-1] >= min_time else len(t)
+    late_index = (t >= max_time).argmax() if t[-1] >= max_time else len(t)
+    _, min_normed_temp, late_condition, early_condition = trajectory_stats(
+        T, T - T[:, :1], early_index, late_index, threshold_temp)
+    return {"t": t, "percentiles": percentiles, "bands": bands, "completed": len(T),
+            "estimates": snowball_estimates(min_normed_temp, late_condition, early_condition, confidence)}
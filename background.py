@@ -3,26 +3,101 @@ from dependencies import *
 ### generates PDFs from Krissansen-Totton et al. (2018) model runs
 
 # function for interpolating between time steps
+# t can be a single age or an array of ages; data has time along axis 0 and any ensemble axes after it,
+# so the result has shape t.shape + data.shape[1:]
 def interp(t,t_arr,data):
-    tstep = t_arr[1]-t_arr[0]
-    i1,i2 = np.where(np.abs(t_arr-t) < tstep)[0]
-    times = t_arr[i1:i2+1] # t1,t2 = t_arr[i1],t_arr[i2]
-    data_t = data[i1:i2+1]
-    linfit = interp1d(times,data_t,axis=0)
-    return linfit(t)
-
-def background_fits(t): # t in Myrs from present
-    # load data
+    t_arr = np.asarray(t_arr)
+    data = np.asarray(data)
+    if t_arr[0] > t_arr[-1]: # searchsorted needs ascending times
+        t_arr, data = t_arr[::-1], data[::-1]
+    t = np.asarray(t, dtype=float)
+    if np.any(t < t_arr[0]) or np.any(t > t_arr[-1]):
+        raise ValueError("age outside of the interpolation range")
+    i = np.clip(np.searchsorted(t_arr, t, side='right') - 1, 0, len(t_arr) - 2) # left neighbour
+    w = (t - t_arr[i]) / (t_arr[i+1] - t_arr[i]) # linear weight of right neighbour
+    w = w.reshape(w.shape + (1,)*(data.ndim - 1))
+    return (1 - w)*data[i] + w*data[i+1]
+
+### binary caches of the background climate data
+# each source is parsed once per process (lru_cache) and once per machine (an .npz file in cache_dir,
+# rebuilt whenever the source file is newer)
+cache_dir = 'data/cache'
+
+# path of a data file, in the data folder or next to the code
+def data_path(filename):
+    path = os.path.join('data', filename)
+    return path if os.path.exists(path) else filename
+
+# load a cached bundle of arrays, building and saving it if missing or stale
+def load_cache(name,source,build):
+    path = os.path.join(cache_dir, name + '.npz')
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(source):
+        with np.load(path) as f:
+            return {key: f[key] for key in f.files}
+    data = build()
     try:
-        all_output = np.load('data/kt_data.npy')
-    except:
-        all_output = np.load('kt_data.npy')
-    t_arr = all_output[4,:,0]/1e6 # time steps in Myrs
+        os.makedirs(cache_dir, exist_ok=True)
+        np.savez(path, **data)
+    except OSError: # read-only deployments just keep the in-memory copy
+        pass
+    return data
+
+# Krissansen-Totton et al. (2018) ensemble: only the variables used here, in model units
+@functools.lru_cache(maxsize=None)
+def kt_data():
+    source = data_path('kt_data.npy')
+    def build():
+        all_output = np.load(source)
+        return {"t": all_output[4,:,0]/1e6, # time steps in Myrs
+                "CO2": all_output[6,:,:]*1e6, # CO2 (ppm)
+                "T": all_output[17,:,:], # surface temp (K)
+                "V": all_output[24,:,:]/1e12} # volcanic degassing (Tmol/yr to examol/Myr)
+    return load_cache('kt_data', source, build)
+
+# distribution fits at every age of the Krissansen-Totton et al. (2018) ensemble
+@functools.lru_cache(maxsize=None)
+def background_fit_table():
+    source = data_path('kt_data.npy')
+    def build():
+        kt = kt_data()
+        return {"t": kt["t"],
+                "CO2_fit": np.array([st.lognorm.fit(CO2) for CO2 in kt["CO2"]]), # log normal: s, loc, scale
+                "T_fit": np.array([st.norm.fit(T) for T in kt["T"]]), # normal: loc, scale
+                "V_fit": np.array([st.norm.fit(V) for V in kt["V"]])} # normal: loc, scale
+    return load_cache('background_fits', source, build)
+
+# Foster et al. (2017) pCO2 compilation
+@functools.lru_cache(maxsize=None)
+def foster_data():
+    source = data_path('foster-2017.xlsx')
+    def build():
+        df = pd.read_excel(source,skiprows=1)
+        return {key: df[key].to_numpy(dtype=float) for key in df.columns}
+    return load_cache('foster-2017', source, build)
+
+# Scotese et al. (2021) global average temperature, 1 Myr version
+@functools.lru_cache(maxsize=None)
+def scotese_data():
+    source = data_path('scotese_2021.xlsx')
+    def build():
+        df = pd.read_excel(source, '1my version').dropna(subset=["Age","GAT"]) # trailing notes rows
+        return {"Age": df["Age"].to_numpy(dtype=float), "GAT": df["GAT"].to_numpy(dtype=float)}
+    return load_cache('scotese_2021', source, build)
+
+# t in Myrs from present
+# by default fits are interpolated from the precomputed table; exact=True refits the interpolated ensemble
+def background_fits(t,exact=False):
+    if not exact:
+        table = background_fit_table()
+        # interp as in the exact path (handles the descending KT ages, raises outside of them)
+        lookup = lambda fits: tuple(np.moveaxis(interp(t, table["t"], fits), -1, 0))
+        return lookup(table["CO2_fit"]),lookup(table["T_fit"]),lookup(table["V_fit"])
 
     # interpolate model runs at specified age
-    CO2 = interp(t,t_arr,all_output[6,:,:])*1e6 # CO2 (ppm)
-    T = interp(t,t_arr,all_output[17,:,:]) # surface temp (K)
-    V = interp(t,t_arr,all_output[24,:,:])/1e12 # volcanic degassing (Tmol/yr to examol/Myr)
+    kt = kt_data()
+    CO2 = interp(t,kt["t"],kt["CO2"]) # CO2 (ppm)
+    T = interp(t,kt["t"],kt["T"]) # surface temp (K)
+    V = interp(t,kt["t"],kt["V"]) # volcanic degassing (examol/Myr)
 
     # create fits
     CO2_fit = st.lognorm.fit(CO2) # log normal: s, loc, scale
@@ -59,9 +134,9 @@ def Foster_CO2(t_Earth,iters,
                N_pi = 2.83, # pre-industrial surficial carbon [examol]
                ppm_pi = 280 # pre-industrial pCO2 [ppm]
                     ):
-    df = pd.read_excel('data/foster-2017.xlsx',skiprows=1)
-    row = df.iloc[(df["Age (Ma)"] - t_Earth).abs().idxmin()]
-    mean, lw68, up68 = row["pCO2 probability maximum"],row["lw68%"], row["up68%"]
+    df = foster_data()
+    row = np.abs(df["Age (Ma)"] - t_Earth).argmin()
+    mean, lw68, up68 = df["pCO2 probability maximum"][row],df["lw68%"][row], df["up68%"][row]
     std = (up68 - lw68) / (2 * st.norm.ppf(0.84))
     CO2_fit = st.norm(loc=mean, scale=std)
     CO2 = CO2_fit.rvs(size=iters) # list of pCO2 values [ppm]
@@ -70,8 +145,7 @@ def Foster_CO2(t_Earth,iters,
 
 # read in Scotese et al. 2021 data and estimate temperature
 def Scotese_T(t_Earth,iters):
-    xls = pd.ExcelFile('data/scotese_2021.xlsx')
-    df = pd.read_excel(xls, '1my version')
-    row = df.iloc[(df["Age"] - t_Earth).abs().idxmin()]
-    T = row["GAT"]+273.15 # C to K
+    df = scotese_data()
+    row = np.abs(df["Age"] - t_Earth).argmin()
+    T = df["GAT"][row]+273.15 # C to K
     return [T]*iters
\ No newline at end of file
@@ -0,0 +1,196 @@
+from dependencies import *
+from defaults import *
+from model import *
+from background import *
+from MC_helpers import *
+from save_data import *
+
+### benchmarks for the model, sampling, execution and I/O hot paths
+# run with `python benchmark.py` (see --help); every benchmark runs in a fresh process so its peak
+# memory can be measured, and results are appended as JSON lines to data/benchmarks.jsonl
+
+# default background climate for benchmark runs (Franklin-like, no data files needed)
+bench_background = {"N0": 4.0, "V": 7.0, "T0": 288.0}
+
+# sampled parameters with a fixed background climate
+def bench_params(iters, seed=0):
+    params = sample_params(iters, param_ranges, dt, t_max, method="random", seed=seed)
+    for key, val in bench_background.items():
+        params[key] = np.full(iters, val)
+    return params
+
+# output file in a scratch directory, removed after the benchmark (see run_benchmark)
+scratch_dirs = []
+def scratch_file(name="bench.nc"):
+    scratch_dirs.append(tempfile.mkdtemp())
+    return os.path.join(scratch_dirs[-1], name)
+
+# a single parameter set as keyword arguments for run_model
+def bench_model_kwargs():
+    params = bench_params(1)
+    model_params, _ = slice_params(params)
+    return {key: val[0] for key, val in model_params.items()}
+
+## benchmarks: each takes a size and returns a function to time (setup is not timed)
+
+def bench_run_model(size):
+    kwargs = bench_model_kwargs()
+    return lambda: [run_model(**kwargs) for _ in range(size)]
+
+def bench_run_model_prognostics(size):
+    kwargs = bench_model_kwargs()
+    return lambda: [run_model(**kwargs, prognostics=True) for _ in range(size)]
+
+def bench_erosion_conditions(size):
+    return lambda: [erosion_conditions(dt=dt, B=100., H=1., P=200., E=50.) for _ in range(size)]
+
+def bench_sample_params(size):
+    return lambda: sample_params(size, param_ranges, dt=dt, t_max=t_max)
+
+def bench_dict_array(size):
+    params = bench_params(size)
+    return lambda: dict_array(params)
+
+def bench_parallel(mode):
+    def bench(size):
+        params = bench_params(size)
+        kwargs = {"scalar": {}, "batch": {"batch_size": 1000},
+                  "processes": {"batch_size": 1000, "processes": True}}[mode]
+        return lambda: run_model_iters_parallel(params, print_progress=False, **kwargs)
+    return bench
+
+def bench_save_data(size):
+    params = bench_params(size)
+    t = model_time(dt, t_max)
+    T = 288 + np.random.default_rng(0).normal(size=(size, len(t)))
+    filename = scratch_file()
+    return lambda: save_data(filename, t, T, params, description="benchmark")
+
+def bench_summary_stats(size):
+    params = bench_params(size)
+    t = model_time(dt, t_max)
+    T = 288 - np.random.default_rng(0).uniform(0, 20, size)[:, None]*np.sin(np.pi*t/t_max)
+    filename = scratch_file()
+    save_data(filename, t, T, params, description="benchmark")
+    return lambda: summary_stats(filename, print_progress=False)
+
+def bench_background_fits(size):
+    kt_data() # load once, as every call after the first
+    ages = np.linspace(100, 1000, size)
+    return lambda: [background_fits(age) for age in ages]
+
+# name: (benchmark, default sizes, units of the size)
+benchmarks = {
+    "run_model": (bench_run_model, [20], "runs"),
+    "run_model[prognostics]": (bench_run_model_prognostics, [20], "runs"),
+    "erosion_conditions": (bench_erosion_conditions, [100_000], "calls"),
+    "sample_params": (bench_sample_params, [100_000], "iters"),
+    "dict_array": (bench_dict_array, [100_000], "iters"),
+    "run_model_iters_parallel[scalar]": (bench_parallel("scalar"), [1_000], "iters"), # ~10 iters/s
+    "run_model_iters_parallel[batch]": (bench_parallel("batch"), [1_000, 10_000, 100_000], "iters"),
+    "run_model_iters_parallel[processes]": (bench_parallel("processes"), [1_000, 10_000, 100_000], "iters"),
+    "save_data": (bench_save_data, [1_000, 10_000], "iters"),
+    "summary_stats": (bench_summary_stats, [1_000, 10_000], "iters"),
+    "background_fits": (bench_background_fits, [100], "calls"),
+}
+
+# peak resident memory [MB] of this process (RUSAGE_SELF), or of the largest finished child process,
+# e.g. a pool worker (RUSAGE_CHILDREN)
+def peak_memory_mb(who=resource.RUSAGE_SELF):
+    peak = resource.getrusage(who).ru_maxrss
+    return peak/1e6 if platform.system() == "Darwin" else peak/1e3 # bytes on macOS, kB on Linux
+
+# run one benchmark (in a worker process) and return its measurements; peak_memory_mb is the larger of
+# this process and its largest worker, so process pool benchmarks aren't reported as cheaper than they are
+def run_benchmark(name, size):
+    bench, _, units = benchmarks[name]
+    try:
+        fn = bench(size)
+        memory_before = peak_memory_mb()
+        start = time.perf_counter()
+        fn()
+        wall_time = time.perf_counter() - start
+    finally:
+        while scratch_dirs:
+            shutil.rmtree(scratch_dirs.pop(), ignore_errors=True)
+    memory, worker_memory = peak_memory_mb(), peak_memory_mb(resource.RUSAGE_CHILDREN)
+    return {"benchmark": name, "size": size, "units": units,
+            "wall_time_s": wall_time, "throughput": size/wall_time, # units per second
+            "peak_memory_mb": max(memory, worker_memory), "peak_memory_increase_mb": memory - memory_before,
+            "peak_process_memory_mb": memory, "peak_worker_memory_mb": worker_memory}
+
+# commit of the working tree (with a "+dirty" suffix for uncommitted changes), if in a git repository
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True,
+                               text=True, check=True).stdout.strip()
+        return commit + ("+dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# latest earlier result for the same benchmark and size from a different commit
+def previous_result(results, record):
+    for old in reversed(results):
+        if (old["benchmark"], old["size"]) == (record["benchmark"], record["size"]) \
+                and old.get("commit") != record["commit"]:
+            return old
+    return None
+
+# read the results file (one JSON record per line)
+def read_benchmarks(filename="data/benchmarks.jsonl"):
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the model, sampling, execution and I/O hot paths")
+    parser.add_argument("names", nargs="*", help="benchmarks to run (default: all); see --list")
+    parser.add_argument("--sizes", type=lambda s: [int(float(val)) for val in s.split(",")],
+                        help="comma-separated sizes, overriding each benchmark's defaults")
+    parser.add_argument("--quick", action="store_true", help="only run the smallest size of each benchmark")
+    parser.add_argument("--output", default="data/benchmarks.jsonl", help="results file (JSON lines)")
+    parser.add_argument("--list", action="store_true", help="list benchmarks and default sizes")
+    args = parser.parse_args()
+
+    if args.list:
+        for name, (_, sizes, units) in benchmarks.items():
+            print(f"{name}: {', '.join(f'{size:,}' for size in sizes)} {units}")
+        return
+
+    names = args.names or list(benchmarks)
+    unknown = [name for name in names if name not in benchmarks]
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(unknown)}")
+
+    environment = {"commit": git_commit(), "timestamp": datetime.now().isoformat(timespec="seconds"),
+                   "python": platform.python_version(), "numpy": np.__version__,
+                   "machine": platform.node(), "cpus": os.cpu_count()}
+    previous = read_benchmarks(args.output)
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+
+    for name in names:
+        _, sizes, units = benchmarks[name]
+        sizes = args.sizes or sizes
+        for size in sizes[:1] if args.quick else sizes:
+            try:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+                    record = {**executor.submit(run_benchmark, name, size).result(), **environment}
+            except Exception as e: # e.g. missing background data files
+                print(f"{name} ({size:,} {units}) failed: {e}")
+                continue
+
+            with open(args.output, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+            line = (f"{name} ({size:,} {units}): {record['wall_time_s']:.3f} s, "
+                    f"{record['throughput']:,.1f} {units}/s, peak {record['peak_memory_mb']:,.0f} MB")
+            old = previous_result(previous, record)
+            if old:
+                line += f", {record['throughput']/old['throughput']:.2f}x throughput of {old['commit']}"
+            print(line)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+from dependencies import *
+from defaults import *
+from model import *
+from background import *
+from MC_helpers import *
+from save_data import *
+
+### command-line entry point for headless runs, driven by JSON scenario files (see scenarios/)
+#   python cli.py generate scenarios/Franklin.json   sample, run and save an MC ensemble, then summary stats
+#   python cli.py stats data/Franklin_100k.nc        summary stats of a saved run (or of a scenario's output)
+#   python cli.py sweep scenarios/geologic.json      run and save a parameter sweep
+#
+# scenario keys (all optional except those a subcommand needs):
+#   "description": saved into the output file
+#   "output": NetCDF file written by generate
+#   "iters": number of MC iterations
+#   "dt", "t_max": time step and run time [Myr] (defaults.py values otherwise)
+#   "param_ranges": overrides of defaults.param_ranges ([low, high] to sample, a number to fix)
+#   "sampling": keywords of sample_params (method, seed, chunk_size)
+#   "t_Earth": age [Ma] for the background climate (background_ranges); with "phanerozoic": true, the
+#              Foster et al. (2017) pCO2 and Scotese et al. (2021) temperatures are used where available
+#   "params": fixed values for every iteration, applied after sampling (e.g. a LIP area, or N0/V/T0)
+#   "run": keywords of run_model_iters_to_file (batch_size, processes, workers)
+#   "storage": keywords of create_data_file (chunk_iters, zlib, dtype, ...)
+#   "stats": keywords of summary_stats (threshold_temp, min_time, max_time, save_normed_temp)
+#   "sweep": {"output", "coords": {dim: values or {"linspace"/"logspace": [start, stop, num]}},
+#             "params": {key: value or [dims, values]}} for sweep_grid; dt, t_max, d, Xm and a default to
+#             defaults.py and other fixed values are taken from "params"
+
+def load_scenario(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+# grid coordinates from a list of values or a {"linspace"/"logspace": [start, stop, num]} spec
+def scenario_coords(spec):
+    if isinstance(spec, dict):
+        (kind, (start, stop, num)), = spec.items()
+        return {"linspace": np.linspace, "logspace": np.logspace}[kind](start, stop, int(num))
+    return np.asarray(spec, dtype=float)
+
+# sampled parameters of a scenario, with background climate and fixed values
+def scenario_params(scenario, iters=None):
+    iters = iters or scenario["iters"]
+    ranges = {**param_ranges, **{key: tuple(val) if isinstance(val, list) else val
+                                 for key, val in scenario.get("param_ranges", {}).items()}}
+    sampling = scenario.get("sampling", {})
+    if sampling.get("seed") is not None:
+        np.random.seed(sampling["seed"]) # background draws use the global random state
+    params = sample_params(iters, ranges, scenario.get("dt", dt), scenario.get("t_max", t_max), **sampling)
+
+    if "t_Earth" in scenario:
+        t_Earth = scenario["t_Earth"]
+        N0, V, T0 = background_ranges(t_Earth, iters)
+        if scenario.get("phanerozoic") and t_Earth <= 419:
+            N0 = Foster_CO2(t_Earth, iters)
+        if scenario.get("phanerozoic") and t_Earth <= 540:
+            T0 = Scotese_T(t_Earth, iters)
+        params.update({"N0": N0, "V": V, "T0": T0})
+
+    for key, val in scenario.get("params", {}).items():
+        params[key] = np.full(iters, float(val))
+
+    missing = [key for key in ["N0", "V", "T0"] if key not in params]
+    if missing:
+        raise ValueError(f"scenario needs t_Earth or fixed values for {', '.join(missing)}")
+    return params
+
+def generate(args):
+    scenario = load_scenario(args.scenario)
+    output = args.output or scenario["output"]
+    params = scenario_params(scenario, args.iters)
+    run_model_iters_to_file(output, params, description=scenario.get("description"),
+                            print_progress=not args.quiet, **scenario.get("run", {}),
+                            **scenario.get("storage", {}))
+    if not args.no_stats:
+        summary_stats(output, print_progress=not args.quiet, **scenario.get("stats", {}))
+
+def stats(args):
+    filename, stats_kwargs = args.target, {}
+    if args.target.endswith(".json"):
+        scenario = load_scenario(args.target)
+        filename, stats_kwargs = scenario["output"], scenario.get("stats", {})
+    with netCDF4.Dataset(filename, "r") as ncfile:
+        has_stats = "stats" in ncfile.groups
+    if has_stats:
+        read_summary_stats(filename)
+    else:
+        summary_stats(filename, **stats_kwargs)
+
+def sweep(args):
+    scenario = load_scenario(args.scenario)
+    spec = scenario["sweep"]
+    coords = {dim: scenario_coords(values) for dim, values in spec["coords"].items()}
+    params = {"dt": scenario.get("dt", dt), "t_max": scenario.get("t_max", t_max), "d": d, "Xm": Xm, "a": a,
+              **scenario.get("params", {})}
+    for key, val in spec.get("params", {}).items():
+        params[key] = (val[0], np.asarray(val[1], dtype=float)) if isinstance(val, list) else val
+    for dim in coords:
+        params.pop(dim, None) # swept
+    result = sweep_grid(coords, params, print_progress=not args.quiet, **scenario.get("run", {}))
+    save_sweep(args.output or spec["output"], result, description=scenario.get("description"))
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless Monte Carlo runs driven by scenario files")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = subparsers.add_parser("generate", help="sample, run and save an MC ensemble")
+    generate_parser.add_argument("scenario", help="scenario file (JSON)")
+    generate_parser.add_argument("--iters", type=lambda s: int(float(s)), help="override the scenario's iterations")
+    generate_parser.add_argument("--output", help="override the scenario's output file")
+    generate_parser.add_argument("--no-stats", action="store_true", help="don't compute summary stats")
+    generate_parser.add_argument("--quiet", action="store_true", help="don't print progress")
+    generate_parser.set_defaults(fn=generate)
+
+    stats_parser = subparsers.add_parser("stats", help="summary stats of a saved run (computed if missing)")
+    stats_parser.add_argument("target", help="NetCDF file, or scenario file (JSON) whose output to use")
+    stats_parser.set_defaults(fn=stats)
+
+    sweep_parser = subparsers.add_parser("sweep", help="run and save a parameter sweep")
+    sweep_parser.add_argument("scenario", help="scenario file (JSON) with a sweep section")
+    sweep_parser.add_argument("--output", help="override the sweep's output file")
+    sweep_parser.add_argument("--quiet", action="store_true", help="don't print progress")
+    sweep_parser.set_defaults(fn=sweep)
+
+    args = parser.parse_args()
+    args.fn(args)
+
+if __name__ == "__main__":
+    main()
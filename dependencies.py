@@ -1,13 +1,65 @@
 import numpy as np
 import os
-from scipy.interpolate import interp1d
-import scipy.stats as st
-import matplotlib.pyplot as plt
-import pandas as pd
+import sys
+import importlib
+import threading
+import types
+
+# heavy dependencies (scipy, matplotlib, pandas, seaborn, netCDF4) are imported on first use, so running
+# the model and the MC functions only loads NumPy; each is a stand-in module that imports the real one when
+# an attribute is first accessed, under a lock so worker threads can share it (importlib's LazyLoader
+# isn't thread-safe: threads racing on the first access can see a half-initialized module)
+import_lock = threading.RLock()
+
+class LazyModule(types.ModuleType):
+    def __getattr__(self, attr):
+        module = self.__dict__.get("_real_module")
+        if module is None:
+            with import_lock:
+                module = self.__dict__.get("_real_module") or importlib.import_module(self.__name__)
+                self.__dict__["_real_module"] = module
+        return getattr(module, attr)
+
+def lazy_import(name):
+    return LazyModule(name)
+
+st = lazy_import("scipy.stats")
+plt = lazy_import("matplotlib.pyplot")
+pd = lazy_import("pandas")
+sns = lazy_import("seaborn")
+interpolate = lazy_import("scipy.interpolate")
+integrate = lazy_import("scipy.integrate")
+netCDF4 = lazy_import("netCDF4")
+
+# the real classes and functions, looked up (and their modules loaded) on first access, e.g. with
+# dependencies.Dataset or `from dependencies import Dataset`; star imports leave them out, so within the
+# repo use the lazy modules (netCDF4.Dataset, interpolate.interp1d, integrate.solve_ivp)
+lazy_attributes = {"interp1d": interpolate, "solve_ivp": integrate, "Dataset": netCDF4}
+
+def __getattr__(name):
+    if name in lazy_attributes:
+        return getattr(lazy_attributes[name], name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 import re
-import seaborn as sns
 import concurrent.futures
-from netCDF4 import Dataset
+from multiprocessing import shared_memory
 import time
 from datetime import datetime
-import shutil
\ No newline at end of file
+import shutil
+import json
+import functools
+import inspect
+import argparse
+import platform
+import resource
+import subprocess
+import tempfile
+import collections
+import contextlib
+import threading
+import cProfile
+import pstats
+import io
+import hashlib
+import warnings
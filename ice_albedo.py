@@ -0,0 +1,100 @@
+from dependencies import *
+
+### zero-dimensional ice-albedo model for the Snowball initiation threshold (2.3_ice_albedo)
+# every function takes arrays: pCO2, initial albedos and any config value (e.g. a sweep over Ti) broadcast
+# against each other, so whole bifurcation diagrams are solved at once
+
+# solar constant [W/m2] t_Earth billion years ago (Gough et al. 1981), and the pCO2 [ppm] whose forcing
+# balances the weaker Sun
+def faint_sun(t_Earth=0.72, S_now=1361, albedo_now=0.3, b=5.35, pCO2_now=280):
+    L_L0 = 1/(1+2/5*(1-(4.5-t_Earth)/4.5))
+    S = L_L0*S_now
+    F_diff = (S_now-S)/4*(1-albedo_now) # difference in absorbed solar radiation
+    return S, np.exp(F_diff/b)*pCO2_now
+
+S_Neo, pCO2_Neo = faint_sun(0.72)
+
+ice_albedo_defaults = {
+    "Ti": 260,    # ice-covered temp [K]
+    "To": 295,    # ice-free temp [K]
+    "ai": 0.6,    # ice-covered albedo
+    "ao": 0.2,    # ice-free albedo
+    "T0": 288,    # initial temperature [K]
+    "b": 5.35,    # CO2 radiative forcing coefficient [W/m2]
+    "a_coeff": 2, # temperature response to radiative forcing [W/m2/K]
+    "S": S_Neo,   # Neoproterozoic solar constant [W/m2]
+    "pCO20": pCO2_Neo # assume CO2 balanced weaker solar forcing [ppm]
+}
+
+# planetary albedo: ai below Ti, ao above To, quadratic in between
+def albedo(T, config=ice_albedo_defaults):
+    Ti, To, ai, ao = config["Ti"], config["To"], config["ai"], config["ao"]
+    with np.errstate(invalid='ignore'):
+        return np.where(T <= Ti, ai, np.where(T < To, ao + (ai - ao) * (T - To)**2 / (Ti - To)**2, ao))
+
+# solar forcing of albedo a relative to the initial state
+def delS(a, config=ice_albedo_defaults):
+    S = config["S"]
+    a0 = albedo(config["T0"], config=config)
+    return S * (1 - a) / 4 - S * (1 - a0) / 4
+
+# CO2 forcing relative to the initial pCO2
+def delCO2(pCO2, config=ice_albedo_defaults):
+    return config["b"] * np.log(pCO2/config["pCO20"])
+
+# temperature change from albedo a and pCO2
+def delT(a, pCO2, config=ice_albedo_defaults):
+    return (delS(a=a, config=config) + delCO2(pCO2, config=config)) / config["a_coeff"]
+
+# equilibrium temperature by fixed-point iteration of T -> T0 + delT(albedo(T)), starting from albedo a0
+# (< ai to start in a snowball, > ao to start ice-free); each element stops once its temperature changes
+# by less than threshold [K], or after max_iters; returns an array of the broadcast shape of the inputs
+def equilibrium_temp(pCO2, a0=0.3, config=ice_albedo_defaults, threshold=0.1, max_iters=1000):
+    keys = ["Ti", "To", "ai", "ao", "T0", "b", "a_coeff", "S", "pCO20"]
+    shape = np.broadcast_shapes(np.shape(pCO2), np.shape(a0), *[np.shape(config[key]) for key in keys])
+    flat = {key: np.broadcast_to(np.asarray(config[key], dtype=float), shape).ravel() for key in keys}
+    pCO2 = np.broadcast_to(np.asarray(pCO2, dtype=float), shape).ravel()
+    a = np.broadcast_to(np.asarray(a0, dtype=float), shape).ravel().copy()
+
+    T = flat["T0"].copy()
+    active = np.arange(T.size) # elements still iterating
+    for i in range(max_iters):
+        sub = {key: val[active] for key, val in flat.items()}
+        new_T = sub["T0"] + delT(a=a[active], pCO2=pCO2[active], config=sub)
+        converged = np.abs(new_T - T[active]) < threshold
+        T[active] = new_T
+        active = active[~converged]
+        if not active.size:
+            break
+        a[active] = albedo(T[active], config={key: val[active] for key, val in flat.items()})
+    return T.reshape(shape)
+
+# hysteresis branches: equilibrium temperatures starting from an ice-covered (a0=1) and an ice-free (a0=0) state
+def hysteresis_branches(pCO2, config=ice_albedo_defaults, **kwargs):
+    return (equilibrium_temp(pCO2, a0=1, config=config, **kwargs),
+            equilibrium_temp(pCO2, a0=0, config=config, **kwargs))
+
+# largest gap between equilibrium temperatures along the last axis (the jump of a branch): the temperatures
+# either side of it, and the pCO2 values at those positions if pCO2_arr is given (T increases with pCO2)
+def find_gap(T_arr, pCO2_arr=None):
+    sorted_arr = np.sort(T_arr, axis=-1)
+    gap_idx = np.argmax(np.diff(sorted_arr, axis=-1), axis=-1)[..., None]
+    lower_max = np.take_along_axis(sorted_arr, gap_idx, axis=-1)[..., 0]
+    upper_min = np.take_along_axis(sorted_arr, gap_idx + 1, axis=-1)[..., 0]
+    if pCO2_arr is not None:
+        pCO2_arr = np.broadcast_to(pCO2_arr, np.shape(T_arr))
+        lower_max_pCO2 = np.take_along_axis(pCO2_arr, gap_idx, axis=-1)[..., 0]
+        upper_min_pCO2 = np.take_along_axis(pCO2_arr, gap_idx + 1, axis=-1)[..., 0]
+        return lower_max, upper_min, lower_max_pCO2, upper_min_pCO2
+    return lower_max, upper_min
+
+# glaciation and deglaciation thresholds over pCO2 (the last axis; config values may add leading axes,
+# e.g. Ti of shape (n, 1) for a sweep): the temperature and pCO2 at which each branch jumps, and where to
+def bifurcation_thresholds(pCO2, config=ice_albedo_defaults, **kwargs):
+    start_ice, start_icefree = hysteresis_branches(pCO2, config=config, **kwargs)
+    cold, warm, cold_pCO2, warm_pCO2 = find_gap(start_icefree, pCO2)
+    glaciation = {"T": warm, "T_after": cold, "pCO2": warm_pCO2}
+    cold, warm, cold_pCO2, warm_pCO2 = find_gap(start_ice, pCO2)
+    deglaciation = {"T": cold, "T_after": warm, "pCO2": cold_pCO2}
+    return {"start_ice": start_ice, "start_icefree": start_icefree,
+            "glaciation": glaciation, "deglaciation": deglaciation}
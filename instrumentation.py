@@ -0,0 +1,140 @@
+from dependencies import *
+
+### instrumentation for MC runs: progress events, phase timers and timing reports
+
+# print time in seconds or minutes
+def sec_min_str(time_sec):
+    return f"{int(time_sec // 60)} minutes" if time_sec >= 60 else f"{int(time_sec)} seconds"
+
+## progress events
+# callbacks receive a dict for every event:
+#   "event": "start", "update" or "end"
+#   "iters", "completed": total and completed iterations
+#   "time", "elapsed": wall clock time and seconds since the start
+#   "rate": moving-average throughput over the last rate_window seconds [iters/s] (the expected rate at start)
+#   "eta": estimated seconds until completion at that rate
+
+# start tracking an MC run and send the start event
+# rate: expected throughput [iters/s] for the first estimate (None for the observed 250 iters every 10 seconds)
+def start_progress(iters, callbacks=(), rate=None, rate_window=60):
+    start_time = time.time()
+    rate = rate or 250 / 10
+    progress = {"iters": iters, "start_time": start_time, "callbacks": list(callbacks),
+                "history": collections.deque([(start_time, 0)]), "rate_window": rate_window, "rate": rate}
+    send_progress(progress, "start", 0, start_time)
+    return progress
+
+def update_progress(progress, completed):
+    current_time = time.time()
+    history = progress["history"]
+    history.append((current_time, completed))
+    while len(history) > 2 and current_time - history[1][0] > progress["rate_window"]:
+        history.popleft() # keep one point older than the window
+    (first_time, first_completed) = history[0]
+    if current_time > first_time and completed > first_completed:
+        progress["rate"] = (completed - first_completed) / (current_time - first_time)
+    send_progress(progress, "update", completed, current_time)
+
+def end_progress(progress):
+    current_time = time.time()
+    send_progress(progress, "end", progress["history"][-1][1], current_time)
+
+def send_progress(progress, event, completed, current_time):
+    event = {"event": event, "iters": progress["iters"], "completed": completed,
+             "time": current_time, "elapsed": current_time - progress["start_time"],
+             "rate": progress["rate"], "eta": (progress["iters"] - completed) / progress["rate"]}
+    for callback in progress["callbacks"]:
+        callback(event)
+
+# progress callback printing the start, updates every 10/30/120 seconds (depending on the number of
+# iterations) and the end
+def print_progress_callback():
+    state = {}
+    def callback(event):
+        clock = lambda seconds: datetime.fromtimestamp(seconds).strftime('%I:%M %p')
+        if event["event"] == "start":
+            iters = event["iters"]
+            state["interval"] = 10 if iters < 500 else 30 if iters < 100000 else 120
+            state["next_print_time"] = event["time"] + state["interval"]
+            print(f"Starting {iters:,} iterations at {clock(event['time'])}")
+            print(f"Estimating completion in {sec_min_str(event['eta'])} at {clock(event['time'] + event['eta'])}")
+        elif event["event"] == "update" and event["time"] >= state["next_print_time"]:
+            print(f"    Completed {event['completed']:,}/{event['iters']:,} iterations after "
+                  f"{sec_min_str(event['elapsed'])} ({event['rate']:,.0f} iters/s, "
+                  f"about {sec_min_str(event['eta'])} left)")
+            state["next_print_time"] += state["interval"]
+        elif event["event"] == "end":
+            print(f"Completed {event['iters']:,} iterations after {sec_min_str(event['elapsed'])} "
+                  f"at {clock(event['time'])}")
+    return callback
+
+# callbacks for a run: the print callback if print_progress, plus any given
+def progress_callbacks(print_progress, callbacks=None):
+    return ([print_progress_callback()] if print_progress else []) + list(callbacks or [])
+
+## phase timers
+# wall time spent in each phase, summed over calls (and over worker threads, for phases inside workers);
+# phases inside worker processes are not collected
+phase_timers = {}
+phase_lock = threading.Lock()
+
+# time a block of code as a phase
+@contextlib.contextmanager
+def timed(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with phase_lock:
+            timer = phase_timers.setdefault(phase, {"calls": 0, "seconds": 0.0})
+            timer["calls"] += 1
+            timer["seconds"] += elapsed
+
+# decorator timing every call of a function as a phase
+def timed_phase(phase):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timed(phase):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# copy of the phase timers
+def phase_report():
+    with phase_lock:
+        return {phase: dict(timer) for phase, timer in phase_timers.items()}
+
+def reset_phase_timers():
+    with phase_lock:
+        phase_timers.clear()
+
+## timing reports
+# profile a function call with cProfile, returning its result and the pstats report as text
+def profile_call(fn, *args, sort="cumulative", limit=30, **kwargs):
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        result = fn(*args, **kwargs)
+    finally:
+        profiler.disable()
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats(sort).print_stats(limit)
+    return result, stream.getvalue()
+
+# write a timing report (phase timers and an optional profile) into the global attributes of a NetCDF
+# file, or into a sidecar JSON file next to it (filename + ".timing.json")
+def write_timing_report(filename, phases=None, profile=None, sidecar=False):
+    report = {"created": datetime.now().isoformat(timespec="seconds"),
+              "phases": phase_report() if phases is None else phases}
+    if profile is not None:
+        report["profile"] = profile
+    if sidecar:
+        with open(filename + ".timing.json", "w") as f:
+            json.dump(report, f, indent=2)
+        return
+    with netCDF4.Dataset(filename, "a") as ncfile:
+        ncfile.timing_phases = json.dumps(report["phases"])
+        if profile is not None:
+            ncfile.timing_profile = profile
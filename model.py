@@ -26,6 +26,36 @@ def erosion_conditions(dt, # time step [Myr]
 
     return w,H,B
 
+# vectorized erosion_conditions for arrays of runs (returns new arrays, no in-place updates)
+def erosion_conditions_batch(dt, # time step [Myr]
+        B, # bedrock depth [m]
+        H, # regolith depth [m]
+        P, # sap. prod. rate [m/Myr]
+        E # erosion rate [m/Myr]
+        ):
+    # chemical weathering
+    w_max = P*dt # max sap. produced [m]
+    w = np.minimum(w_max,B) # can't weather more than B
+    H = H + w
+    B = B - w
+
+    # physical erosion
+    dz = E*dt # max total rock eroded [m]
+    H = H - dz
+    B = np.where(H < 0, B + H, B) # eroded through regolith
+
+    H = np.maximum(0,H)
+    B = np.maximum(0,B)
+
+    return w,H,B
+
+# time array produced by run_model for a given time step and run length
+def model_time(dt,t_max):
+    t = [0]
+    while t[-1] < t_max:
+        t.append(t[-1]+dt)
+    return np.array(t)
+
 # carbon cycle model with LIP
 def run_model(
         ## Model characteristics
@@ -124,6 +154,346 @@ def run_model(
     else:
         return np.array(t),np.array(N)
 
+# set up parameters and initial state for an ensemble of runs advanced in lockstep
+# every parameter can be a scalar or an array with one value per run
+def init_model_batch(dt, t_max, # model characteristics
+                     emp_dur, A0, B0, erup_freq, degass, # LIP emplacement characteristics
+                     P0, E_P, d, c, Xm, # LIP weathering characteristics
+                     N0, V, # background climate
+                     n, n_p, n_e # climate sensitivities
+                     ):
+    keys = ["dt","t_max","emp_dur","A0","B0","erup_freq","degass",
+            "P0","E_P","d","c","Xm","N0","V","n","n_p","n_e"]
+    values = np.broadcast_arrays(
+        *[np.atleast_1d(np.asarray(p, dtype=float)) for p in
+          (dt, t_max, emp_dur, A0, B0, erup_freq, degass, P0, E_P, d, c, Xm, N0, V, n, n_p, n_e)])
+    p = dict(zip(keys, values))
+
+    ## Emplacement characteristic calculations
+    erup_num = p["emp_dur"]/p["erup_freq"] # number of eruptions
+    p["B_e"] = p["B0"]/erup_num # height extruded each eruption [m]
+    p["degass_e"] = p["degass"]/erup_num # CO2 degassed each eruption [examol CO2]
+
+    ## Erosion
+    p["E0"] = p["E_P"]*p["P0"]
+
+    ## Initial state
+    iters = len(p["dt"])
+    state = {
+        "t": np.zeros(iters), # time [Myr]
+        "N": p["N0"].copy(), # surficial carbon [examol]
+        "B": p["B_e"].copy(), # bedrock [m]
+        "H": np.zeros(iters), # regolith [m]
+        "P": p["P0"].copy(),
+        "E": p["E0"].copy(),
+        "degass": p["degass_e"].copy(),
+        "last_erup": np.zeros(iters), # time of last eruption [Myr]
+    }
+    return p, state
+
+# apply eruptions to the current state in place (as run_model does before each step)
+def erupt_batch(state,p,active):
+    t = state["t"]
+    erupt = active & (t-state["last_erup"] > p["erup_freq"]) & (t < p["emp_dur"])
+    state["B"][erupt] += p["B_e"][erupt] # erupt bedrock
+    state["H"][erupt] = 0 # reset regolith
+    state["degass"][erupt] = p["degass_e"][erupt] # degass
+    state["last_erup"][erupt] = t[erupt] # keep track of eruption time
+
+# advance every active run one time step; runs that already finished become NaN
+def step_model_batch(state,p,active):
+    with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+        # global weathering
+        y = (state["N"]/p["N0"])**2 # normalized atmospheric pCO2
+        W = p["V"]*(y**p["n"]) # global silicate weathering [examol/Myr]
+
+        # LIP saprolite production
+        P_i = p["P0"]*np.exp(-state["H"]/p["d"]) # soil production function
+        P_i *= y**p["n_p"] # climate dependence
+
+        # LIP erosion
+        E_i = p["E0"]*(state["B"]/p["B_e"])**p["c"] # dependence on slope
+        E_i *= y**p["n_e"] # climate dependence
+
+        # LIP weathering
+        w_i,H_i,B_i = erosion_conditions_batch(dt=p["dt"],B=state["B"],H=state["H"],P=P_i,E=E_i)
+        dC_i = w_i*p["A0"]*p["Xm"]/1e18 # m m2 mol/m3 --> examol
+
+        # increment surficial carbon
+        N_i = state["N"] + p["V"]*p["dt"] - W*p["dt"] - dC_i + state["degass"]
+
+    new_state = {
+        "t": state["t"] + p["dt"],
+        "N": N_i,
+        "B": B_i,
+        "H": H_i,
+        "P": P_i,
+        "E": E_i,
+        "degass": np.zeros(len(N_i)), # don't degass if no eruption
+    }
+    new_state = {key: np.where(active, val, np.nan) for key,val in new_state.items()}
+    new_state["last_erup"] = state["last_erup"]
+    return new_state
+
+# carbon cycle model with LIP for an ensemble of parameter sets, advanced in lockstep
+# every parameter can be a scalar or an array with one value per run; outputs are 2D (runs x time steps)
+# runs with a shorter time grid (different dt or t_max) are padded with NaN after their last step
+def run_model_batch(dt, t_max, # model characteristics
+                    emp_dur, A0, B0, erup_freq, degass, # LIP emplacement characteristics
+                    P0, E_P, d, c, Xm, # LIP weathering characteristics
+                    N0, V, # background climate
+                    n, n_p, n_e, # climate sensitivities
+                    prognostics = False
+                    ):
+    p, state = init_model_batch(dt=dt, t_max=t_max, emp_dur=emp_dur, A0=A0, B0=B0,
+                                erup_freq=erup_freq, degass=degass, P0=P0, E_P=E_P, d=d, c=c, Xm=Xm,
+                                N0=N0, V=V, n=n, n_p=n_p, n_e=n_e)
+
+    steps = []
+    while True:
+        active = state["t"] < p["t_max"] # runs still integrating (NaN once finished)
+        erupt_batch(state,p,active)
+        steps.append(state)
+        if not active.any():
+            break
+        state = step_model_batch(state,p,active)
+
+    keys = ["t","N","B","H","P","E","degass"]
+    t,N,B,H,P,E,degass_arr = [np.stack([step[key] for step in steps], axis=1) for key in keys]
+
+    if prognostics:
+        return [t,N,B,H,P,E,degass_arr]
+    else:
+        return t,N
+
+# runs run_model_batch and reduces temperature on the fly to the quantities summary_stats saves,
+# without storing trajectories
+# early_stop: stop integrating once every run has passed max_time
+# stop_decided: also drop runs that crossed the threshold before min_time (their min temps then only
+#               cover the integrated part of the run)
+def run_model_batch_stats(T0, b, a, # temperature response
+                          threshold_temp=280, # temperature threshold [K]
+                          min_time=0.9, # min time to snowball [Myr]
+                          max_time=2.15, # max time to snowball [Myr]
+                          early_stop=True,
+                          stop_decided=False,
+                          **model_params):
+    p, state = init_model_batch(**model_params)
+    iters = len(p["dt"])
+    T0, b, a = np.broadcast_arrays(*[np.atleast_1d(np.asarray(val, dtype=float)) for val in (T0, b, a)])
+    T0, b, a = [np.broadcast_to(val, (iters,)) for val in (T0, b, a)]
+
+    stats = {
+        "min_temp": np.full(iters, np.inf),
+        "min_normed_temp": np.full(iters, np.inf),
+        "late_flag": np.zeros(iters, dtype=bool),
+        "early_flag": np.zeros(iters, dtype=bool),
+        "steps": np.zeros(iters, dtype=int), # number of time steps integrated
+    }
+    idx = np.arange(iters) # runs still being integrated
+    T_init = T0 + x(p["N0"], p["N0"], b, a)
+
+    while True:
+        active = state["t"] < p["t_max"]
+        erupt_batch(state,p,active)
+
+        # reductions over the time steps before max_time (as summary_stats)
+        T = T0[idx] + x(state["N"], p["N0"], b[idx], a[idx])
+        in_window = state["t"] < max_time
+        below = in_window & (T < threshold_temp)
+        stats["min_temp"][idx] = np.where(in_window, np.minimum(stats["min_temp"][idx], T), stats["min_temp"][idx])
+        normed = T - T_init[idx]
+        stats["min_normed_temp"][idx] = np.where(in_window, np.minimum(stats["min_normed_temp"][idx], normed),
+                                                 stats["min_normed_temp"][idx])
+        stats["late_flag"][idx] |= below
+        stats["early_flag"][idx] |= below & (state["t"] < min_time)
+        stats["steps"][idx] += 1
+
+        # drop runs whose outcome is decided
+        keep = active.copy()
+        if early_stop:
+            keep &= in_window
+        if stop_decided:
+            keep &= ~stats["early_flag"][idx]
+        if not keep.all():
+            idx = idx[keep]
+            state = {key: val[keep] for key,val in state.items()}
+            p = {key: val[keep] for key,val in p.items()}
+            active = active[keep]
+        if not len(idx):
+            break
+        state = step_model_batch(state,p,active)
+
+    stats["min_temp"][np.isinf(stats["min_temp"])] = np.nan
+    stats["min_normed_temp"][np.isinf(stats["min_normed_temp"])] = np.nan
+    stats["snowball_flag"] = stats["late_flag"] & ~stats["early_flag"]
+    return stats
+
+# continuous-time version of run_model with error-controlled adaptive steps (scipy solve_ivp)
+# eruptions happen at exact multiples of erup_freq and are applied as discrete events; the
+# regolith/bedrock branches of erosion_conditions (bare bedrock, exhausted bedrock) are detected
+# as events that switch the set of equations
+# results are reported on t_out (by default the run_model time grid), with values at an eruption
+# time taken just before the eruption
+def run_model_adaptive(
+        ## Model characteristics
+        dt, # time step of the default output grid [Myr]
+        t_max,  # time to run until [Myr]
+        ## LIP emplacement characteristics
+        emp_dur, A0, B0, erup_freq, degass,
+        ## LIP weathering characteristics
+        P0, E_P, d, c, Xm,
+        ## Background climate
+        N0, V,
+        ## Climate sensitivities
+        n, n_p, n_e,
+        # Output
+        prognostics = False,
+        t_out = None, # output time grid [Myr]
+        # Integrator (see adaptive_agreement in MC_helpers.py for the agreement with run_model)
+        rtol = 1e-6,
+        atol = 1e-9,
+        method = "LSODA",
+        return_steps = False # also return the number of integrator steps taken
+        ):
+
+    ## Emplacement characteristic calculations
+    erup_num = emp_dur/erup_freq # number of eruptions
+    B_e = B0/erup_num # height extruded each eruption [m]
+    degass_e = degass/erup_num # CO2 degassed each eruption [examol CO2]
+
+    ## Erosion
+    E0 = E_P*P0
+
+    ## Output grid and eruption times
+    if t_out is None:
+        t_out = model_time(dt, t_max)
+    t_out = np.asarray(t_out, dtype=float)
+    t_end = t_out[-1]
+    erup_times = erup_freq*np.arange(int(np.ceil(emp_dur/erup_freq)) + 1)
+    erup_times = erup_times[(erup_times < emp_dur) & (erup_times <= t_end)]
+
+    # weathering, saprolite production and erosion rates
+    def rates(N, B, H):
+        with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+            y = (N/N0)**2 # normalized atmospheric pCO2
+            W = V*(y**n) # global silicate weathering [examol/Myr]
+            P = P0*np.exp(-H/d)*y**n_p # saprolite production [m/Myr]
+            E = E0*(B/B_e)**c*y**n_e # erosion [m/Myr]
+        return W, P, E
+
+    # which branch of erosion_conditions applies
+    def regime(state):
+        N, B, H = state
+        W, P, E = rates(N, B, H)
+        if B <= 0:
+            return "exhausted" if H > 0 else "depleted" # no bedrock left to weather (nor regolith to erode)
+        if H <= 0 and E >= P:
+            return "bare" # erosion strips regolith as fast as it forms and eats into bedrock
+        return "weathering"
+
+    def rhs(reg):
+        def f(t, state):
+            N, B, H = state
+            W, P, E = rates(N, max(B, 0), max(H, 0))
+            if reg == "weathering":
+                dB, dH, w = -P, P - E, P
+            elif reg == "bare":
+                dB, dH, w = -E, 0, P
+            elif reg == "exhausted":
+                dB, dH, w = 0, -E, 0
+            else:
+                dB, dH, w = 0, 0, 0
+            dN = V - W - w*A0*Xm/1e18 # m/Myr m2 mol/m3 --> examol/Myr
+            return [dN, dB, dH]
+        return f
+
+    def event(fn, direction):
+        fn.terminal = True
+        fn.direction = direction
+        return fn
+
+    def events(reg):
+        H_zero = event(lambda t, s: s[2], -1) # regolith eroded away
+        B_zero = event(lambda t, s: s[1], -1) # bedrock exhausted
+        P_above_E = event(lambda t, s: np.subtract(*rates(*s)[1:]), 1) # regolith starts to accumulate again
+        if reg == "weathering":
+            return [H_zero, B_zero]
+        elif reg == "bare":
+            return [P_above_E, B_zero]
+        elif reg == "exhausted":
+            return [H_zero]
+        return []
+
+    ## Set up model
+    state = np.array([N0, B_e, 0.0]) # surficial carbon [examol], bedrock [m], regolith [m]
+    out = np.full((3, len(t_out)), np.nan)
+    out[:, t_out <= 0] = state[:, None]
+    steps = 0
+
+    state[0] += degass_e # first eruption degasses at t = 0
+    t_now = 0
+    for t_next in np.append(erup_times[1:], t_end):
+        # integrate up to the next eruption, switching equations at regolith/bedrock events
+        reg = regime(state)
+        for _ in range(10_000):
+            if t_now >= t_next:
+                break
+            ivp_kwargs = dict(events=events(reg), dense_output=True, rtol=rtol, atol=atol)
+            try:
+                sol = integrate.solve_ivp(rhs(reg), (t_now, t_next), state, method=method, **ivp_kwargs)
+            except ValueError: # event bracketing can fail on LSODA's dense output right after a switch
+                sol = integrate.solve_ivp(rhs(reg), (t_now, t_next), state, method="Radau", **ivp_kwargs)
+            steps += len(sol.t) - 1
+            t_stop = sol.t[-1]
+
+            mask = (t_out > t_now) & (t_out <= t_stop)
+            if mask.any():
+                out[:, mask] = sol.sol(t_out[mask])
+
+            state = sol.y[:, -1].copy()
+            if sol.status == 1:
+                # clamp the variable that reached zero and switch equations
+                fired = [len(times) > 0 for times in sol.t_events]
+                if reg in ["weathering", "bare"] and fired[1]:
+                    state[1] = 0
+                    reg = regime(state)
+                elif reg == "weathering" and fired[0]:
+                    state[2] = 0
+                    reg = regime(state)
+                elif reg == "bare" and fired[0]:
+                    reg = "weathering"
+                elif reg == "exhausted" and fired[0]:
+                    state[2] = 0
+                    reg = "depleted"
+            elif not sol.success:
+                raise RuntimeError(f"Integration failed at t = {t_now} Myr: {sol.message}")
+            t_now = t_stop
+        else:
+            raise RuntimeError(f"Too many regolith/bedrock events before t = {t_next} Myr")
+
+        # eruption at the end of this interval
+        if t_next in erup_times:
+            state[1] += B_e # erupt bedrock
+            state[2] = 0 # reset regolith
+            state[0] += degass_e # degass
+
+    N, B, H = out
+    B, H = np.maximum(B, 0), np.maximum(H, 0)
+
+    if prognostics:
+        W, P, E = rates(N, B, H)
+        P = np.where(B > 0, P, 0) # no saprolite production without bedrock
+        # degassing released in each output interval, as in run_model
+        degass_arr = np.zeros(len(t_out))
+        np.add.at(degass_arr, np.searchsorted(t_out, erup_times, side="right") - 1, degass_e)
+        results = [t_out, N, B, H, P, E, degass_arr]
+    else:
+        results = [t_out, N]
+    if return_steps:
+        results.append(steps)
+    return results if prognostics else tuple(results)
+
 # temperature response to CO2
 def x(N,N0,b,a):
     with np.errstate(over='ignore'):
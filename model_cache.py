@@ -0,0 +1,138 @@
+from dependencies import *
+from model import *
+
+### content-addressed cache of model runs
+# results are keyed by a hash of the model function, its arguments (order-independent, exact float values)
+# and the model source, so editing model.py invalidates every entry; runs are kept in an in-memory LRU
+# tier bounded in bytes and, if a directory is configured, in an on-disk tier shared between processes
+
+run_cache = {"entries": collections.OrderedDict(), # key: tuple of read-only arrays, least recently used first
+             "bytes": 0,
+             "max_bytes": 256e6, # memory tier size [bytes]
+             "disk_dir": None, # on-disk tier directory (None to keep the cache in memory only)
+             "hits": 0, "disk_hits": 0, "misses": 0}
+run_cache_lock = threading.Lock()
+
+# set the memory tier size and/or the on-disk tier directory (e.g. "data/cache/runs")
+def configure_run_cache(max_bytes=None, disk_dir=None):
+    with run_cache_lock:
+        if max_bytes is not None:
+            run_cache["max_bytes"] = max_bytes
+        if disk_dir is not None:
+            run_cache["disk_dir"] = disk_dir or None # "" turns the disk tier off
+        evict_runs()
+
+# hash of the model source (model.py)
+@functools.lru_cache(maxsize=None)
+def model_version():
+    return hashlib.sha256(inspect.getsource(inspect.getmodule(run_model)).encode()).hexdigest()[:16]
+
+# canonical hash of a model call: numbers are compared by exact float value, whatever their type
+def run_key(fn_name, kwargs):
+    def canonical(val):
+        if isinstance(val, (bool, np.bool_)):
+            return str(bool(val))
+        return float(val).hex()
+    items = ",".join(f"{key}={canonical(kwargs[key])}" for key in sorted(kwargs))
+    return hashlib.sha256(f"{fn_name}({items})@{model_version()}".encode()).hexdigest()
+
+def disk_path(key):
+    return os.path.join(run_cache["disk_dir"], key[:2], key + ".npz")
+
+# drop least recently used runs until the memory tier fits (call with the lock held)
+def evict_runs():
+    entries = run_cache["entries"]
+    while entries and run_cache["bytes"] > run_cache["max_bytes"]:
+        _, arrays = entries.popitem(last=False)
+        run_cache["bytes"] -= sum(arr.nbytes for arr in arrays)
+
+def store_run(key, arrays, disk=True):
+    arrays = tuple(np.array(arr) for arr in arrays)
+    for arr in arrays:
+        arr.flags.writeable = False # results are shared between callers
+    with run_cache_lock:
+        if key not in run_cache["entries"]:
+            run_cache["entries"][key] = arrays
+            run_cache["bytes"] += sum(arr.nbytes for arr in arrays)
+            evict_runs()
+        disk_dir = run_cache["disk_dir"]
+    if disk and disk_dir:
+        path = disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                np.savez(f, *arrays)
+            os.replace(tmp, path) # concurrent writers store identical results
+        except OSError: # read-only or full disk: keep the memory tier only
+            pass
+    return arrays
+
+# cached arrays of a run, or None (counts a hit or a miss)
+def lookup_run(key):
+    with run_cache_lock:
+        arrays = run_cache["entries"].get(key)
+        if arrays is not None:
+            run_cache["entries"].move_to_end(key)
+            run_cache["hits"] += 1
+            return arrays
+        disk_dir = run_cache["disk_dir"]
+    if disk_dir and os.path.exists(disk_path(key)):
+        try:
+            with np.load(disk_path(key)) as f:
+                arrays = tuple(f[f"arr_{i}"] for i in range(len(f.files)))
+        except (OSError, ValueError): # partially deleted or corrupt entry: treat as a miss
+            arrays = None
+        if arrays is not None:
+            with run_cache_lock:
+                run_cache["disk_hits"] += 1
+            return store_run(key, arrays, disk=False)
+    with run_cache_lock:
+        run_cache["misses"] += 1
+    return None
+
+# run_model with caching; returns the same outputs as run_model (as read-only arrays)
+def cached_run_model(**kwargs):
+    key = run_key("run_model", kwargs)
+    arrays = lookup_run(key)
+    if arrays is None:
+        arrays = store_run(key, run_model(**kwargs))
+    return list(arrays) if kwargs.get("prognostics") else tuple(arrays)
+
+# run_model_batch with caching per run: only the runs missing from the cache are integrated (in one batch);
+# returns t and N like run_model_batch without prognostics (padded with NaN for shorter time grids)
+def cached_run_model_batch(**params):
+    iters = len(np.atleast_1d(params["dt"]))
+    params = {key: np.broadcast_to(val, (iters,)) for key, val in params.items()}
+    keys = [run_key("run_model_batch", {key: val[i] for key, val in params.items()}) for i in range(iters)]
+    found = [lookup_run(key) for key in keys]
+    missing = [i for i in range(iters) if found[i] is None]
+    if missing:
+        t, N = run_model_batch(**{key: val[missing] for key, val in params.items()})
+        for j, i in enumerate(missing):
+            steps = ~np.isnan(t[j]) # drop the padding
+            found[i] = store_run(keys[i], (t[j][steps], N[j][steps]))
+
+    t = np.full((iters, max(len(arrays[0]) for arrays in found)), np.nan)
+    N = np.full(t.shape, np.nan)
+    for i, (t_i, N_i) in enumerate(found):
+        t[i, :len(t_i)], N[i, :len(N_i)] = t_i, N_i
+    return t, N
+
+# hit/miss counters and size of the cache
+def run_cache_stats():
+    with run_cache_lock:
+        lookups = run_cache["hits"] + run_cache["disk_hits"] + run_cache["misses"]
+        return {"hits": run_cache["hits"], "disk_hits": run_cache["disk_hits"], "misses": run_cache["misses"],
+                "hit_rate": (run_cache["hits"] + run_cache["disk_hits"])/lookups if lookups else 0.0,
+                "entries": len(run_cache["entries"]), "bytes": run_cache["bytes"]}
+
+# empty the memory tier and reset the counters (and delete the on-disk tier if disk)
+def clear_run_cache(disk=False):
+    with run_cache_lock:
+        run_cache["entries"].clear()
+        run_cache["bytes"] = 0
+        run_cache["hits"] = run_cache["disk_hits"] = run_cache["misses"] = 0
+        disk_dir = run_cache["disk_dir"]
+    if disk and disk_dir and os.path.exists(disk_dir):
+        shutil.rmtree(disk_dir)
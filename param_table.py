@@ -0,0 +1,101 @@
+from dependencies import *
+from defaults import *
+
+### columnar parameter tables: one contiguous float64 column per sampled parameter, fixed parameters
+### stored once, and units for every parameter
+# a table is a dict:
+#   "iters": number of iterations
+#   "keys": parameter names, in order
+#   "columns": {key: float64 array of length iters} for parameters that vary between iterations
+#   "constants": {key: float} for parameters fixed across the run
+#   "units": {key: units string}
+
+# derived parameters written into the params group (see write_params), dropped when reading
+derived_params = ["E0", "erup_num"]
+
+# units of the params group that differ from model units: (units in the file, factor to model units)
+file_units = {"A0": ("Mkm^2", 1e12), "B0": ("km", 1e3)}
+
+def is_param_table(params):
+    return isinstance(params, dict) and "columns" in params and "constants" in params
+
+# build a table from a dictionary of per-iteration values (lists or arrays) or a list of dictionaries;
+# parameters with a single value across all iterations become constants
+def param_table(params, units=None, param_metadata=param_metadata):
+    if isinstance(params, (list, tuple)):
+        params = {key: [row[key] for row in params] for key in params[0]}
+    units = units or {}
+    table = {"iters": None, "keys": list(params), "columns": {}, "constants": {}, "units": {}}
+    for key, val in params.items():
+        val = np.asarray(val, dtype=float)
+        if val.ndim == 0: # a single value for every iteration
+            table["constants"][key] = float(val)
+            continue
+        if table["iters"] is None:
+            table["iters"] = len(val)
+        elif len(val) != table["iters"]:
+            raise ValueError(f"parameter {key} has {len(val)} values, expected {table['iters']}")
+        if len(val) and (val[0] == val).all():
+            table["constants"][key] = float(val[0])
+        else:
+            table["columns"][key] = np.ascontiguousarray(val)
+    for key in params:
+        table["units"][key] = units.get(key, param_metadata.get(key, {}).get("units", ""))
+    table["iters"] = table["iters"] or 0
+    return table
+
+# values of one parameter for every iteration (a read-only broadcast view for constants)
+def table_column(table, key):
+    if key in table["columns"]:
+        return table["columns"][key]
+    return np.broadcast_to(table["constants"][key], (table["iters"],))
+
+# dictionary of per-iteration arrays, as used by the MC functions (views, no copies)
+def table_params(table):
+    return {key: table_column(table, key) for key in table["keys"]}
+
+# parameters as a dictionary of per-iteration values, from a table or a dictionary
+def as_params(params):
+    return table_params(params) if is_param_table(params) else params
+
+# table of a subset of iterations: a slice gives views of the columns, an index or boolean mask
+# (e.g. snowball_flag == 1) copies only the varying columns
+def table_rows(table, index):
+    columns = {key: val[index] for key, val in table["columns"].items()}
+    if columns:
+        iters = len(next(iter(columns.values())))
+    else:
+        iters = len(np.arange(table["iters"])[index])
+    return {**table, "iters": iters, "columns": columns}
+
+# table with a parameter set to a single value, or to per-iteration values
+def table_with(table, key, val):
+    val = np.asarray(val, dtype=float)
+    columns = {k: v for k, v in table["columns"].items() if k != key}
+    constants = {k: v for k, v in table["constants"].items() if k != key}
+    if val.ndim == 0:
+        constants[key] = float(val)
+    elif len(val) != table["iters"]:
+        raise ValueError(f"parameter {key} has {len(val)} values, expected {table['iters']}")
+    else:
+        columns[key] = np.ascontiguousarray(val)
+    keys = table["keys"] + ([key] if key not in table["keys"] else [])
+    units = {**table["units"], key: table["units"].get(key, param_metadata.get(key, {}).get("units", ""))}
+    return {**table, "keys": keys, "columns": columns, "constants": constants, "units": units}
+
+# read the params group of a saved run into a table in model units (A0 in m^2, B0 in m), without the
+# derived parameters; index selects a subset of iterations (e.g. a boolean mask of flagged runs)
+def read_param_table(filename, index=None):
+    with netCDF4.Dataset(filename, "r") as ncfile:
+        params_group = ncfile.groups["params"]
+        params, units = {}, {}
+        for key, var in params_group.variables.items():
+            if key in derived_params:
+                continue
+            val = np.ma.filled(var[:], np.nan).astype(float)
+            units[key] = getattr(var, "units", "")
+            if key in file_units:
+                val *= file_units[key][1]
+                units[key] = param_metadata.get(key, {}).get("units", units[key])
+            params[key] = val if index is None else val[index]
+    return param_table(params, units=units)
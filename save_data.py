@@ -1,165 +1,683 @@
 from dependencies import *
 from defaults import *
+from instrumentation import *
+from param_table import *
 
-# save data from an MC run into a NetCDF file
-def save_data(filename,t,T,params,description=None,print_progress=False,param_metadata=param_metadata):
-    with Dataset(filename, "w", format="NETCDF4") as ncfile:
-        
-        ## basic setup  and saving results
-        if print_progress:
-            print("Saving results...")
-        
-        # add comments
+# write the sampled parameters (and derived parameters) into the params group
+# unit conversions are applied before writing, so each variable is written once
+def write_params(ncfile,params,param_metadata=param_metadata):
+    params_dim = ncfile.createDimension("parameters", len(params.keys()))
+    params_group = ncfile.createGroup("params")
+
+    # initial record
+    for key in params:
+        param_var = params_group.createVariable(key, "f8", ("iterations",))
+        if key in param_metadata:
+            param_var.long_name = param_metadata[key]["long_name"]
+            param_var.units = param_metadata[key]["units"]
+
+        # change units of area and height
+        if key in file_units:
+            param_var.units = file_units[key][0]
+    
+    # new parameter: erosion rate (not as ratio)
+    E0_var = params_group.createVariable("E0", "f8", ("iterations",))
+    E0_var.units = params_group.variables["P0"].units
+    E0_var.long_name = "Erosion rate"
+    
+    # new parameter: number of eruptions
+    erup_var = params_group.createVariable("erup_num", "f8", ("iterations",))
+    erup_var.units = "dimensionless"
+    erup_var.long_name = "Number of eruptions"
+
+    write_param_block(ncfile, 0, params)
+
+# write parameter values (and derived parameters) for a block of iterations starting at start
+def write_param_block(ncfile,start,params):
+    params_group = ncfile.groups["params"]
+    params = {key: np.asarray(val, dtype=float) for key, val in params.items()}
+    for key, val in params.items():
+        if key in file_units:
+            val = val/file_units[key][1] # m2 to Mkm2, m to km
+        params_group.variables[key][start:start+len(val)] = val
+    stop = start + len(params["P0"])
+    params_group.variables["E0"][start:stop] = params["P0"]*params["E_P"]
+    params_group.variables["erup_num"][start:stop] = params["emp_dur"]/params["erup_freq"]
+
+# open a NetCDF file for an MC run, writing time and parameters up front;
+# temperature blocks are then written with write_block as they finish
+def create_data_file(filename,t,params,description=None,
+                     chunk_iters=256, # iterations per HDF5 chunk (None for netCDF default chunking)
+                     chunk_steps=None, # time steps per HDF5 chunk (None for the whole time series)
+                     zlib=True,complevel=4,shuffle=True, # compression
+                     dtype="f8", # "f4" to store temperatures as float32
+                     least_significant_digit=None, # quantize temperatures to this many decimals (lossy)
+                     param_metadata=param_metadata,
+                     unlimited=False): # if True, the iterations dimension grows as blocks are appended
+    params = as_params(params)
+    iters = len(params["T0"])
+    ncfile = netCDF4.Dataset(filename, "w", format="NETCDF4")
+
+    # add comments
+    if description is not None:
         ncfile.description = description
 
-        # iteration dimension/variable
-        iters_dim = ncfile.createDimension("iterations", len(T))
-        #iter_var = ncfile.createVariable("iteration", "i4", ("iterations",))
-        #iter_var[:] = np.arange(len(T))
+    # iteration dimension
+    iters_dim = ncfile.createDimension("iterations", None if unlimited else iters)
 
-        # time dimension/variable
-        time_dim = ncfile.createDimension("time_steps", len(t))
-        time_var = ncfile.createVariable("time", "f8", ("time_steps",))        
-        time_var[:] = t
-        time_var.units = "Myr"
-        
-        # temperature results variable
-        temp_var = ncfile.createVariable("temperature", "f8", ("iterations", "time_steps"))
-        temp_var[:, :] = T
-        temp_var.units = "K"
-
-        ## saving parameters
-        if print_progress:
-            print("Saving parameters...")
-            
-        params_dim = ncfile.createDimension("parameters", len(params.keys()))
+    # time dimension/variable
+    time_dim = ncfile.createDimension("time_steps", len(t))
+    time_var = ncfile.createVariable("time", "f8", ("time_steps",))
+    time_var[:] = t
+    time_var.units = "Myr"
+
+    # temperature results variable
+    chunksizes = None
+    if chunk_iters:
+        chunksizes = (min(chunk_iters, iters), min(chunk_steps or len(t), len(t)))
+    temp_var = ncfile.createVariable("temperature", dtype, ("iterations", "time_steps"),
+                                     zlib=zlib, complevel=complevel, shuffle=shuffle,
+                                     chunksizes=chunksizes,
+                                     least_significant_digit=least_significant_digit)
+    temp_var.units = "K"
+
+    # parameters
+    write_params(ncfile, params, param_metadata=param_metadata)
+    return ncfile
+
+# write temperatures for a block of iterations starting at start
+def write_block(ncfile,start,T):
+    ncfile.variables["temperature"][start:start+len(T), :] = T
+
+# save data from an MC run into a NetCDF file
+# storage keywords (chunk_iters, zlib, dtype, least_significant_digit, ...) are passed to create_data_file
+@timed_phase("save_data")
+def save_data(filename,t,T,params,description=None,print_progress=False,param_metadata=param_metadata,
+              block_size=10_000, # iterations written per call
+              **storage):
+    storage = {"chunk_iters": None, "zlib": False, **storage} # uncompressed with default chunking unless requested
+
+    ## basic setup and saving parameters
+    if print_progress:
+        print("Saving results...")
+    ncfile = create_data_file(filename, t, params, description=description,
+                              param_metadata=param_metadata, **storage)
+
+    ## saving results
+    with ncfile:
+        for start in range(0, len(T), block_size):
+            write_block(ncfile, start, T[start:start+block_size])
+
+    print(f"Data saved to {filename}")
+
+# save a labeled parameter sweep from sweep_grid into a NetCDF file: one dimension and coordinate
+# variable per grid dimension, parameters on the dimensions they vary along, and the minimum temperatures
+def save_sweep(filename,sweep,description=None,param_metadata=param_metadata):
+    with netCDF4.Dataset(filename, "w", format="NETCDF4") as ncfile:
+        if description is not None:
+            ncfile.description = description
+
+        # grid dimensions
+        for dim in sweep["dims"]:
+            ncfile.createDimension(dim, len(sweep["coords"][dim]))
+            coord_var = ncfile.createVariable(dim, "f8", (dim,))
+            coord_var[:] = sweep["coords"][dim]
+
+        # parameters
         params_group = ncfile.createGroup("params")
+        for key, (param_dims, values) in sweep["params"].items():
+            param_var = params_group.createVariable(key, "f8", param_dims)
+            param_var[...] = values
+            if key in param_metadata:
+                param_var.long_name = param_metadata[key]["long_name"]
+                param_var.units = param_metadata[key]["units"]
+
+        # results
+        for key, long_name in [("min_temp", "Minimum temperature"),
+                               ("min_normed_temp", "Minimum normalized temperature")]:
+            result_var = ncfile.createVariable(key, "f8", sweep["dims"])
+            result_var[:] = sweep[key]
+            result_var.long_name = long_name
+            result_var.units = "K"
+
+    print(f"Sweep saved to {filename}")
 
-        # initial record
-        param_vars = {}
-        for key, val in params.items():
-            param_vars[key] = params_group.createVariable(key, "f8", ("iterations",))
-            param_vars[key][:] = np.array(val)
+# read a sweep saved with save_sweep back into the sweep_grid layout
+def read_sweep(filename):
+    with netCDF4.Dataset(filename, "r") as ncfile:
+        dims = tuple(ncfile.dimensions)
+        sweep = {"dims": dims,
+                 "coords": {dim: np.ma.filled(ncfile.variables[dim][:], np.nan) for dim in dims},
+                 "params": {key: (var.dimensions, np.ma.filled(var[...], np.nan))
+                            for key, var in ncfile.groups["params"].variables.items()}}
+        for key in ["min_temp", "min_normed_temp"]:
+            sweep[key] = np.ma.filled(ncfile.variables[key][:], np.nan)
+    return sweep
+
+# save critical parameter values from critical_snowball (or a single critical_values result)
+# alongside the parameter sets they were solved for
+def save_critical(filename,critical,params,key,bounds,description=None,
+                  threshold_temp=280,min_time=0.9,max_time=2.15,param_metadata=param_metadata):
+    if "critical" in critical:
+        critical = {"flag": critical}
+    with netCDF4.Dataset(filename, "w", format="NETCDF4") as ncfile:
+        if description is not None:
+            ncfile.description = description
+        params = as_params(params)
+        ncfile.createDimension("iterations", len(params["T0"]))
+        write_params(ncfile, params, param_metadata=param_metadata)
+
+        critical_group = ncfile.createGroup("critical")
+        critical_group.parameter = key
+        critical_group.bounds = np.asarray(bounds, dtype=float)
+        critical_group.threshold_temp = threshold_temp
+        critical_group.min_time = min_time
+        critical_group.max_time = max_time
+        for flag, result in critical.items():
+            critical_var = critical_group.createVariable(f"{flag}_critical", "f8", ("iterations",))
+            critical_var[:] = result["critical"]
+            critical_var.long_name = f"Value of {key} at which {flag.replace('_', ' ')} switches (NaN if not within bounds)"
             if key in param_metadata:
-                param_vars[key].long_name = param_metadata[key]["long_name"]
-                param_vars[key].units = param_metadata[key]["units"]
-                
-        # change units of area and height
-        params_group.variables["A0"][:] /= 1e12 # m to Mkm2
-        params_group.variables["A0"].units = "Mkm^2"
-        params_group.variables["B0"][:] /= 1e3 # m to km
-        params_group.variables["B0"].units = "km"
-        
-        # new parameter: erosion rate (not as ratio)
-        E0_var = params_group.createVariable("E0", "f8", ("iterations",))
-        E0_var[:] = params_group.variables["P0"][:]*params_group.variables["E_P"][:]
-        E0_var.units = params_group.variables["P0"].units
-        E0_var.long_name = "Erosion rate"
-        
-        # new parameter: number of eruptions
-        erup_var = params_group.createVariable("erup_num", "f8", ("iterations",))
-        erup_var[:] = params_group.variables["emp_dur"][:]/params_group.variables["erup_freq"][:]
-        erup_var.units = "dimensionless"
-        erup_var.long_name = "Number of eruptions"
-        
+                critical_var.units = param_metadata[key]["units"]
+            for end in ["low", "high"]:
+                end_var = critical_group.createVariable(f"{flag}_{end}", "i1", ("iterations",))
+                end_var[:] = result[f"flag_{end}"].astype("i1")
+                end_var.long_name = f"{flag.replace('_', ' ').capitalize()} at the {'lower' if end == 'low' else 'upper'} bound"
+                end_var.units = "boolean"
+
+    print(f"Critical values saved to {filename}")
+
+# read critical values saved with save_critical, in the critical_snowball layout
+def read_critical(filename):
+    with netCDF4.Dataset(filename, "r") as ncfile:
+        critical_group = ncfile.groups["critical"]
+        flags = [name[:-len("_critical")] for name in critical_group.variables if name.endswith("_critical")]
+        critical = {flag: {"critical": np.ma.filled(critical_group.variables[f"{flag}_critical"][:], np.nan),
+                           "flag_low": critical_group.variables[f"{flag}_low"][:].astype(bool),
+                           "flag_high": critical_group.variables[f"{flag}_high"][:].astype(bool)}
+                    for flag in flags}
+    return critical["flag"] if list(critical) == ["flag"] else critical
+
+# save streamed statistics from run_model_iters_stats into a NetCDF file, with the same
+# params and stats groups as save_data + summary_stats; trajectories are saved only for the
+# sampled subset (sample = (sample_index, t, T)), along a separate "samples" dimension
+def save_stats(filename,stats,params,sample=None,description=None,
+               threshold_temp=280,min_time=0.9,max_time=2.15,
+               print_progress=True,param_metadata=param_metadata):
+    params = as_params(params)
+    with netCDF4.Dataset(filename, "w", format="NETCDF4") as ncfile:
+        if description is not None:
+            ncfile.description = description
+        iters_dim = ncfile.createDimension("iterations", len(stats["min_temp"]))
+
+        # trajectories for the sampled subset
+        if sample is not None:
+            sample_index, t, T = sample
+            time_dim = ncfile.createDimension("time_steps", len(t))
+            time_var = ncfile.createVariable("time", "f8", ("time_steps",))
+            time_var[:] = t
+            time_var.units = "Myr"
+
+            samples_dim = ncfile.createDimension("samples", len(sample_index))
+            index_var = ncfile.createVariable("sample_index", "i8", ("samples",))
+            index_var[:] = sample_index
+            index_var.long_name = "Iteration index of each saved trajectory"
+
+            temp_var = ncfile.createVariable("temperature", "f8", ("samples", "time_steps"))
+            temp_var[:, :] = T
+            temp_var.units = "K"
+
+        write_params(ncfile, params, param_metadata=param_metadata)
+
+        stats_group = ncfile.createGroup("stats")
+        write_stats(stats_group,
+                    min_temp=stats["min_temp"], min_normed_temp=stats["min_normed_temp"],
+                    late_condition=stats["late_flag"], early_condition=stats["early_flag"],
+                    threshold_temp=threshold_temp, min_time=min_time, max_time=max_time,
+                    print_progress=print_progress)
+
         print(f"Data saved to {filename}")
-        
+
+# record which runs of a saved MC run were screened out by a surrogate (run_model_iters_screened)
+# and the predicted min temperatures (summary_stats leaves the min temperatures of screened runs NaN)
+def write_screening(filename,screened,predicted):
+    with netCDF4.Dataset(filename, "a") as ncfile:
+        screened_var = ncfile.createVariable("screened", "i1", ("iterations",))
+        screened_var[:] = np.asarray(screened).astype("i1")
+        screened_var.long_name = "Flag if the run was screened out by the surrogate and not integrated"
+        screened_var.units = "boolean"
+
+        predicted_var = ncfile.createVariable("predicted_min_temp", "f8", ("iterations",))
+        predicted_var[:] = predicted
+        predicted_var.long_name = "Surrogate prediction of the min temp"
+        predicted_var.units = "K"
+
+# mean ignoring NaNs, with optional weights
+def weighted_nanmean(values, weights=None):
+    values = np.asarray(values, dtype=float)
+    weights = np.ones_like(values) if weights is None else np.asarray(weights, dtype=float)
+    valid = ~np.isnan(values)
+    return np.sum(values[valid]*weights[valid]) / np.sum(weights[valid])
+
+# importance weights of the iterations in a file (all ones for plain Monte Carlo files)
+def read_weights(filename):
+    with netCDF4.Dataset(filename, "r") as ncfile:
+        if "weight" in ncfile.variables:
+            return np.ma.filled(ncfile.variables["weight"][:], np.nan)
+        return np.ones(len(ncfile.dimensions["iterations"]))
+
+# average cooling line, noting the runs left out of the mean (runs without a min temperature, e.g. screened)
+def cooling_summary(mean, covered, iters, screened=0):
+    line = f"Average cooling: {mean:0.2f} K"
+    if covered < iters:
+        line += f" (over {covered:,} of {iters:,} runs"
+        line += f"; {screened:,} runs screened out as warm are excluded)" if screened else ")"
+    return line
+
+# write per-iteration minimum temperatures, snowball flags and summary percentages into the stats group
+# weights: importance weights of the iterations (e.g. from run_model_iters_adaptive), or None for equal weights
+# screened: number of runs screened out by a surrogate, whose NaN min temperatures the average cooling excludes
+def write_stats(stats_group,min_temp,min_normed_temp,late_condition,early_condition,
+                threshold_temp=280,min_time=0.9,max_time=2.15,print_progress=True,weights=None,screened=0):
+    late_condition = np.asarray(late_condition, dtype=bool)
+    early_condition = np.asarray(early_condition, dtype=bool)
+    snowball_condition = late_condition & ~early_condition
+
+    # min temperature before max time
+    min_temp_var = stats_group.createVariable("min_temp", "f8", ("iterations",))
+    min_temp_var[:] = min_temp
+    min_temp_var.units = "K"
+    min_temp_var.long_name = f"Min temp during model runs before {max_time} Myr"
+
+    # min normalized temperature before max time
+    min_normed_temp_var = stats_group.createVariable("min_normed_temp", "f8", ("iterations",))
+    min_normed_temp_var[:] = min_normed_temp
+    min_normed_temp_var.units = "K"
+    min_normed_temp_var.long_name = f"Min normalized temp during model runs before {max_time} Myr"
+
+    # runs the average cooling covers
+    covered = int((~np.isnan(np.asarray(min_normed_temp, dtype=float))).sum())
+    cooling_var = stats_group.createVariable("cooling_iterations", "i8")
+    cooling_var[:] = covered
+    cooling_var.long_name = "Number of iterations with a min temp, which the average cooling covers"
+    cooling_var.screened_iterations = screened
+
+    if print_progress:
+        print(cooling_summary(weighted_nanmean(min_normed_temp, weights), covered, len(min_normed_temp), screened))
+
+    # save flags
+    late_flag_var = stats_group.createVariable("late_flag", "i1", ("iterations",))
+    late_flag_var[:] = late_condition.astype("i1")
+    late_flag_var.long_name = f"Flag if temp dropped below {threshold_temp}K before {max_time} Myr"
+    late_flag_var.units = "boolean"
+
+    early_flag_var = stats_group.createVariable("early_flag", "i1", ("iterations",))
+    early_flag_var[:] = early_condition.astype("i1")
+    early_flag_var.long_name = f"Flag if temp dropped below {threshold_temp}K before {min_time} Myr"
+    early_flag_var.units = "boolean"
+
+    snowball_flag_var = stats_group.createVariable("snowball_flag", "i1", ("iterations",))
+    snowball_flag_var[:] = snowball_condition.astype("i1")
+    snowball_flag_var.long_name = f"Flag if temp dropped below {threshold_temp}K between {min_time} and {max_time} Myr"
+    snowball_flag_var.units = "boolean"
+
+    # Save summary percentages
+    percentages = {
+        "late_flag_percentage": weighted_nanmean(late_condition, weights) * 100,
+        "early_flag_percentage": weighted_nanmean(early_condition, weights) * 100,
+        "snowball_flag_percentage": weighted_nanmean(snowball_condition, weights) * 100,
+    }
+
+    for name, value in percentages.items():
+        var = stats_group.createVariable(name, "f8")
+        var[:] = value
+        var.long_name = f"Percentage of iterations for {name.replace('_', ' ')}"
+        if weights is not None:
+            var.long_name += " (importance weighted)"
+        var.units = "%"
+
+    if print_progress:
+        for name, value in percentages.items():
+            print(f"{name.replace('_', ' ').capitalize()}: {value:.2f}%")
+
+# per-run min temperatures and threshold flags for a slab of trajectories (as summary_stats)
+# early_index/late_index: first time steps at or after min_time/max_time
+def trajectory_stats(T,normed,early_index,late_index,threshold_temp=280):
+    late_condition = (T[:, :late_index] < threshold_temp).any(axis=1)
+    early_condition = (T[:, :early_index] < threshold_temp).any(axis=1)
+    min_temp = T[:, :late_index].min(axis=1)
+    min_normed_temp = normed[:, :late_index].min(axis=1)
+    return min_temp, min_normed_temp, late_condition, early_condition
+
 # analyze for number of Snowballs and other info
+# streams through the iterations in slabs of block_size, so memory use doesn't depend on the number of runs
+@timed_phase("summary_stats")
 def summary_stats(filename,
                   threshold_temp=280,  # temperature threshold [K]
                   min_time=0.9,  # min time to snowball [Myr]
                   max_time=2.15,  # max time to snowball [Myr]
-                  print_progress=True):
+                  print_progress=True,
+                  block_size=10_000,  # iterations read per slab
+                  save_normed_temp=True):  # also store the full normalized temperature array (the slowest part)
     
-    with Dataset(filename, "a") as ncfile:
+    with netCDF4.Dataset(filename, "a") as ncfile:
         #if print_progress:
             #print("Analyzing, creating summary statistics...")
         stats_group = ncfile.createGroup("stats")
 
         # read in data
-        T = ncfile.variables["temperature"][:]
+        temp_var = ncfile.variables["temperature"]
         t = ncfile.variables["time"][:]
+        iters = len(temp_var)
         
-        # normalized temperature
-        norm_temp_var = stats_group.createVariable("normed_temp", "f8", ("iterations", "time_steps"))
-        for i in range(len(T)):
-            norm_temp_var[i, :] = T[i, :] - T[i, 0]
-        norm_temp_var.units = "K"
-        norm_temp_var.long_name = "Normalized temperature (relative to initial value)"
+        # normalized temperature, stored with the same chunking and compression as temperature
+        if save_normed_temp:
+            filters = temp_var.filters() or {}
+            chunking = temp_var.chunking()
+            norm_temp_var = stats_group.createVariable("normed_temp", "f8", ("iterations", "time_steps"),
+                                                       zlib=bool(filters.get("zlib")), complevel=filters.get("complevel", 4),
+                                                       shuffle=bool(filters.get("shuffle")),
+                                                       chunksizes=None if chunking == "contiguous" else chunking)
+            norm_temp_var.units = "K"
+            norm_temp_var.long_name = "Normalized temperature (relative to initial value)"
 
         # boolean flags for conditions
         early_index = (t >= min_time).argmax()
         late_index = (t >= max_time).argmax()
 
-        late_condition = (T[:, :late_index] < threshold_temp).any(axis=1)
-        early_condition = (T[:, :early_index] < threshold_temp).any(axis=1)
+        min_temp = np.empty(iters)
+        min_normed_temp = np.empty(iters)
+        late_condition = np.empty(iters, dtype=bool)
+        early_condition = np.empty(iters, dtype=bool)
 
-        snowball_condition = late_condition & ~early_condition
+        for start in range(0, iters, block_size):
+            stop = min(start + block_size, iters)
+            T = np.ma.filled(temp_var[start:stop, :].astype("f8"), np.nan) # unwritten values become NaN
 
-        # min temperature before max time
-        min_temp_var = stats_group.createVariable("min_temp", "f8", ("iterations",))
-        min_temp_var[:] = T[:, :late_index].min(axis=1)
-        min_temp_var.units = "K"
-        min_temp_var.long_name = f"Min temp during model runs before {max_time} Myr"
+            normed = T - T[:, :1]
+            if save_normed_temp:
+                norm_temp_var[start:stop, :] = normed
 
-        # min normalized temperature before max time
-        min_normed_temp_var = stats_group.createVariable("min_normed_temp", "f8", ("iterations",))
-        min_normed_temp_var[:] = norm_temp_var[:, :late_index].min(axis=1)
-        min_normed_temp_var.units = "K"
-        min_normed_temp_var.long_name = f"Min normalized temp during model runs before {max_time} Myr"
-        
-        if print_progress:
-            print(f"Average cooling: {np.nanmean(min_normed_temp_var[:]):0.2f} K")
-
-        # save flags
-        late_flag_var = stats_group.createVariable("late_flag", "i1", ("iterations",))
-        late_flag_var[:] = late_condition.astype("i1")
-        late_flag_var.long_name = f"Flag if temp dropped below {threshold_temp}K before {max_time} Myr"
-        late_flag_var.units = "boolean"
-
-        early_flag_var = stats_group.createVariable("early_flag", "i1", ("iterations",))
-        early_flag_var[:] = early_condition.astype("i1")
-        early_flag_var.long_name = f"Flag if temp dropped below {threshold_temp}K before {min_time} Myr"
-        early_flag_var.units = "boolean"
-
-        snowball_flag_var = stats_group.createVariable("snowball_flag", "i1", ("iterations",))
-        snowball_flag_var[:] = snowball_condition.astype("i1")
-        snowball_flag_var.long_name = f"Flag if temp dropped below {threshold_temp}K between {min_time} and {max_time} Myr"
-        snowball_flag_var.units = "boolean"
-
-        # Save summary percentages
-        iters = len(T)
-        percentages = {
-            "late_flag_percentage": (late_condition.sum() / iters * 100),
-            "early_flag_percentage": (early_condition.sum() / iters * 100),
-            "snowball_flag_percentage": (snowball_condition.sum() / iters * 100),
-        }
+            (min_temp[start:stop], min_normed_temp[start:stop],
+             late_condition[start:stop], early_condition[start:stop]) = trajectory_stats(
+                T, normed, early_index, late_index, threshold_temp)
 
-        for name, value in percentages.items():
-            var = stats_group.createVariable(name, "f8")
-            var[:] = value
-            var.long_name = f"Percentage of iterations for {name.replace('_', ' ')}"
-            var.units = "%"
+        # screened runs have no trajectories: their flags stay unset (never below the threshold) and their min
+        # temperatures stay NaN, so they are left out of the mean cooling (the surrogate's prediction, which may
+        # only be a lower bound, is kept in predicted_min_temp)
+        screened = int(ncfile.variables["screened"][:].sum()) if "screened" in ncfile.variables else 0
 
-        if print_progress:
-            for name, value in percentages.items():
-                print(f"{name.replace('_', ' ').capitalize()}: {value:.2f}%")
+        # min temperatures, flags and percentages
+        weights = ncfile.variables["weight"][:] if "weight" in ncfile.variables else None
+        write_stats(stats_group,weights=weights,screened=screened,
+                    min_temp=min_temp,
+                    min_normed_temp=min_normed_temp,
+                    late_condition=late_condition, early_condition=early_condition,
+                    threshold_temp=threshold_temp, min_time=min_time, max_time=max_time,
+                    print_progress=print_progress)
 
+        #if print_progress:
             #print(f"Summary statistics added to {filename}")
             
 # read in summary stats
 def read_summary_stats(filename):
-    with Dataset(filename, "r") as ncfile:
-        print(f"Reading summary statistics from {filename}")
-        
-        stats_group = ncfile.groups["stats"]
-        
-        min_normed_temp = stats_group.variables["min_normed_temp"][...]
-        late_flag_percentage = stats_group.variables["late_flag_percentage"][...]
-        early_flag_percentage = stats_group.variables["early_flag_percentage"][...]
-        snowball_flag_percentage = stats_group.variables["snowball_flag_percentage"][...]
-        
-        print(f"Average cooling: {np.nanmean(min_normed_temp):0.2f} K")
-        print(f"Late flag percentage: {late_flag_percentage:.2f}%")
-        print(f"Early flag percentage: {early_flag_percentage:.2f}%")
-        print(f"Snowball flag percentage: {snowball_flag_percentage:.2f}%")
\ No newline at end of file
+    results = open_results(filename)
+    try:
+        print_summary_stats(results)
+    finally:
+        close_results(results)
+
+def print_summary_stats(results):
+    print(f"Reading summary statistics from {results['filename']}")
+
+    min_normed_temp = results_values(results, "stats/min_normed_temp")
+    late_flag_percentage = results_values(results, "stats/late_flag_percentage")
+    early_flag_percentage = results_values(results, "stats/early_flag_percentage")
+    snowball_flag_percentage = results_values(results, "stats/snowball_flag_percentage")
+
+    covered, screened = int((~np.isnan(min_normed_temp)).sum()), 0
+    if "cooling_iterations" in results["ncfile"].groups["stats"].variables:
+        covered = int(results_values(results, "stats/cooling_iterations"))
+        screened = results_variable(results, "stats/cooling_iterations").screened_iterations
+    print(cooling_summary(weighted_nanmean(min_normed_temp, results_weights(results)), covered, len(min_normed_temp),
+                          screened))
+    print(f"Late flag percentage: {late_flag_percentage:.2f}%")
+    print(f"Early flag percentage: {early_flag_percentage:.2f}%")
+    print(f"Snowball flag percentage: {snowball_flag_percentage:.2f}%")
+
+# lazy reader for analyzing a run: the file is opened once and each variable is read from disk on first use,
+# then cached; variables are named by group ("stats/min_temp", "params/A0") or top-level name ("weight"),
+# with values in the units of the file (masked values as NaN)
+def open_results(filename):
+    return {"filename": filename, "ncfile": netCDF4.Dataset(filename, "r"),
+            "cache": {}, # values of each variable read so far
+            "subsets": {}, # boolean index of each subset
+            "reads": collections.Counter()} # reads from disk per variable
+
+def close_results(results):
+    if results["ncfile"].isopen():
+        results["ncfile"].close()
+
+# NetCDF variable (for its metadata; no values are read)
+def results_variable(results, name):
+    group = results["ncfile"]
+    *groups, key = name.split("/")
+    for group_name in groups:
+        group = group.groups[group_name]
+    return group.variables[key]
+
+def results_values(results, name):
+    if name not in results["cache"]:
+        values = results_variable(results, name)[...]
+        results["cache"][name] = np.ma.filled(np.ma.asarray(values, dtype=float), np.nan)
+        results["reads"][name] += 1
+    return results["cache"][name]
+
+# importance weights of the iterations (all ones for plain Monte Carlo files)
+def results_weights(results):
+    if "weight" in results["ncfile"].variables:
+        return results_values(results, "weight")
+    if "weight" not in results["cache"]:
+        results["cache"]["weight"] = np.ones(len(results["ncfile"].dimensions["iterations"]))
+    return results["cache"]["weight"]
+
+# subsets of iterations: all runs, or the runs with each snowball flag
+results_subsets = {"all": None, "late": "stats/late_flag", "early": "stats/early_flag",
+                   "snowball": "stats/snowball_flag"}
+
+# boolean index of a subset of iterations
+def subset_index(results, subset="all"):
+    if subset not in results["subsets"]:
+        flag = results_subsets[subset]
+        if flag is None:
+            results["subsets"][subset] = np.ones(len(results["ncfile"].dimensions["iterations"]), dtype=bool)
+        else:
+            results["subsets"][subset] = results_values(results, flag) == 1
+    return results["subsets"][subset]
+
+# values and weights of a variable in a subset, without NaNs (e.g. as KDE inputs)
+def subset_values(results, name, subset="all"):
+    index = subset_index(results, subset)
+    values, weights = results_values(results, name)[index], results_weights(results)[index]
+    valid = ~np.isnan(values)
+    return values[valid], weights[valid]
+
+# weighted mean of a variable in a subset
+def subset_mean(results, name, subset="all"):
+    values, weights = subset_values(results, name, subset)
+    return np.average(values, weights=weights)
+
+# weighted histogram of a variable in a subset (as np.histogram)
+def subset_histogram(results, name, subset="all", bins=100, range=None, density=True):
+    values, weights = subset_values(results, name, subset)
+    return np.histogram(values, bins=bins, range=range, weights=weights, density=density)
+
+# precompute a per-run index so snowball criteria can be re-queried without rescanning trajectories:
+#   first_crossing: first time each run drops below each temperature in thresholds (inf if never)
+#   min_envelope: running minimum temperature over all steps before each envelope_time (every envelope_dt)
+# flags are exact for thresholds on the grid and any time window; min temperatures (and flags for
+# other thresholds) are exact for windows whose bounds fall on envelope points (multiples of envelope_dt),
+# and query_stats warns and snaps other windows to the envelope points before them
+def crossing_index(filename,
+                   thresholds=np.arange(260, 300.5, 0.5), # temperature thresholds [K]
+                   envelope_dt=0.05, # time between envelope points [Myr]
+                   block_size=10_000, # iterations read per slab
+                   print_progress=True):
+    thresholds = np.sort(np.asarray(thresholds, dtype=float))
+
+    with netCDF4.Dataset(filename, "a") as ncfile:
+        temp_var = ncfile.variables["temperature"]
+        t = ncfile.variables["time"][:]
+        iters = len(temp_var)
+        # envelope points cover steps [:env_index], with indices found as in summary_stats
+        env_time = np.arange(envelope_dt, t[-1], envelope_dt)
+        env_index = np.unique([(t >= time_i).argmax() for time_i in env_time])
+        env_index = env_index[env_index > 0]
+
+        index_group = ncfile.createGroup("index")
+        index_group.createDimension("thresholds", len(thresholds))
+        index_group.createDimension("envelope_steps", len(env_index))
+
+        thr_var = index_group.createVariable("thresholds", "f8", ("thresholds",))
+        thr_var[:] = thresholds
+        thr_var.units = "K"
+
+        env_index_var = index_group.createVariable("envelope_index", "i8", ("envelope_steps",))
+        env_index_var[:] = env_index
+        env_index_var.long_name = "Envelope covers time steps before this index"
+
+        env_time_var = index_group.createVariable("envelope_time", "f8", ("envelope_steps",))
+        env_time_var[:] = t[env_index] # envelope covers steps with time < envelope_time
+        env_time_var.units = "Myr"
+
+        crossing_var = index_group.createVariable("first_crossing", "f8", ("iterations", "thresholds"))
+        crossing_var.units = "Myr"
+        crossing_var.long_name = "First time temperature dropped below each threshold (inf if never)"
+
+        env_var = index_group.createVariable("min_envelope", "f8", ("iterations", "envelope_steps"))
+        env_var.units = "K"
+        env_var.long_name = "Running minimum temperature before each envelope time"
+
+        nan_var = index_group.createVariable("first_nan", "f8", ("iterations",))
+        nan_var.units = "Myr"
+        nan_var.long_name = "First time temperature was NaN (inf if never)"
+
+        init_var = index_group.createVariable("initial_temp", "f8", ("iterations",))
+        init_var.units = "K"
+        init_var.long_name = "Initial temperature"
+
+        t_inf = np.append(t, np.inf) # step index len(t) means never
+        for start in range(0, iters, block_size):
+            stop = min(start + block_size, iters)
+            T = np.ma.filled(temp_var[start:stop, :].astype("f8"), np.nan)
+
+            # running minimum ignoring NaN (NaN never counts as a crossing, as in summary_stats), with a
+            # -inf step appended so a search that runs past the end stays in the run
+            runmin = np.empty((stop - start, len(t) + 1))
+            np.fmin.accumulate(T, axis=1, out=runmin[:, :-1])
+            runmin[np.isnan(runmin)] = np.inf
+            runmin[:, -1] = -np.inf
+
+            # runmin is non-increasing, so the first crossing of every threshold in every run is found by
+            # bisection on all (run, threshold) pairs at once
+            flat = runmin.ravel()
+            offsets = np.arange(stop - start)[:, None]*(len(t) + 1)
+            lo = np.zeros((stop - start, len(thresholds)), dtype=np.intp)
+            hi = np.full(lo.shape, len(t))
+            for _ in range(len(t).bit_length()):
+                mid = (lo + hi) >> 1
+                below = flat[offsets + mid] < thresholds
+                hi = np.where(below, mid, hi)
+                lo = np.where(below, lo, mid + 1)
+            crossing_var[start:stop, :] = t_inf[lo]
+
+            env_var[start:stop, :] = runmin[:, env_index-1]
+            isnan = np.isnan(T)
+            nan_var[start:stop] = np.where(isnan.any(axis=1), t_inf[isnan.argmax(axis=1)], np.inf)
+            init_var[start:stop] = T[:, 0]
+
+    if print_progress:
+        print(f"Crossing index for {len(thresholds)} thresholds added to {filename}")
+
+# read the crossing index (and time grid) into memory
+def read_crossing_index(filename):
+    with netCDF4.Dataset(filename, "r") as ncfile:
+        index_group = ncfile.groups["index"]
+        index = {key: np.ma.filled(var[:], np.nan) for key, var in index_group.variables.items()}
+        index["time"] = ncfile.variables["time"][:]
+    return index
+
+# snowball flags, min temperatures and percentages for one criterion, answered from the crossing index;
+# "window" holds the (min_time, max_time) actually used for the envelope values, which differ from the
+# requested window (with a warning) when its bounds don't fall on envelope points
+def query_stats(index,
+                threshold_temp=280,  # temperature threshold [K]
+                min_time=0.9,  # min time to snowball [Myr]
+                max_time=2.15):  # max time to snowball [Myr]
+    t = index["time"]
+    iters = len(index["initial_temp"])
+
+    # nearest envelope point at or before step i (-1 if none), and the time up to which it covers steps
+    def envelope_point(i):
+        return np.searchsorted(index["envelope_index"], i, side="right") - 1
+
+    def envelope_time(k):
+        return index["envelope_time"][k] if k >= 0 else t[0]
+
+    # running minimum over the steps before envelope point k
+    def envelope(k):
+        if k < 0:
+            return np.full(iters, np.inf)
+        return index["min_envelope"][:, k]
+
+    # step indices as in summary_stats
+    early_index = (t >= min_time).argmax()
+    late_index = (t >= max_time).argmax()
+    early_k, late_k = envelope_point(early_index), envelope_point(late_index)
+
+    on_grid = np.flatnonzero(np.isclose(index["thresholds"], threshold_temp))
+    if len(on_grid):
+        crossing = index["first_crossing"][:, on_grid[0]]
+        late_condition = crossing < t[late_index] if late_index else np.zeros(iters, dtype=bool)
+        early_condition = crossing < t[early_index] if early_index else np.zeros(iters, dtype=bool)
+    else:
+        late_condition = envelope(late_k) < threshold_temp
+        early_condition = envelope(early_k) < threshold_temp
+    snowball_condition = late_condition & ~early_condition
+
+    # window covered by the envelope values: min temperatures, and flags for thresholds off the grid
+    window = (t[early_index] if len(on_grid) else envelope_time(early_k), envelope_time(late_k))
+    snapped = [name for name, i, time_i in [("min_time", early_index, window[0]), ("max_time", late_index, window[1])]
+               if i and time_i != t[i]]
+    if snapped:
+        warnings.warn(f"{' and '.join(snapped)} not on the envelope grid of the crossing index: using steps before "
+                      f"{window[0]:g} and {window[1]:g} Myr instead (rebuild the index with a finer envelope_dt "
+                      f"for exact values)", stacklevel=2)
+
+    # min temperatures propagate NaN, as in summary_stats
+    min_temp = np.where(index["first_nan"] < window[1], np.nan, envelope(late_k))
+    min_normed_temp = min_temp - index["initial_temp"]
+
+    return {
+        "window": window,
+        "min_temp": min_temp,
+        "min_normed_temp": min_normed_temp,
+        "late_flag": late_condition,
+        "early_flag": early_condition,
+        "snowball_flag": snowball_condition,
+        "late_flag_percentage": late_condition.sum() / iters * 100,
+        "early_flag_percentage": early_condition.sum() / iters * 100,
+        "snowball_flag_percentage": snowball_condition.sum() / iters * 100,
+    }
+
+# percentages and mean cooling for many criteria at once (arguments broadcast against each other)
+def sweep_stats(index, threshold_temp=280, min_time=0.9, max_time=2.15):
+    threshold_temp, min_time, max_time = np.broadcast_arrays(threshold_temp, min_time, max_time)
+    keys = ["late_flag_percentage", "early_flag_percentage", "snowball_flag_percentage", "mean_cooling"]
+    results = {key: np.empty(threshold_temp.shape) for key in keys}
+    for i in np.ndindex(threshold_temp.shape):
+        stats = query_stats(index, threshold_temp[i], min_time[i], max_time[i])
+        stats["mean_cooling"] = np.nanmean(stats["min_normed_temp"])
+        for key in keys:
+            results[key][i] = stats[key]
+    return results
@@ -0,0 +1,34 @@
+from dependencies import *
+from MC_helpers import *
+
+### worker for sharded runs (see create_sharded_run in MC_helpers.py)
+# start on any number of nodes sharing the run directory, e.g. `python shard_worker.py data/shards/CAMP_1M`;
+# each process claims and runs shards until none are left, and --merge combines the finished shards
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the shards of a sharded Monte Carlo run")
+    parser.add_argument("run_dir", help="run directory written by create_sharded_run")
+    parser.add_argument("--processes", type=int, default=1, help="worker processes to start on this node")
+    parser.add_argument("--batch-size", type=int, default=1000, help="iterations per vectorized batch")
+    parser.add_argument("--claim-timeout", type=float, default=None,
+                        help="seconds without progress after which a shard claimed by another worker is taken over")
+    parser.add_argument("--status", action="store_true", help="print the shard status and exit")
+    parser.add_argument("--merge", metavar="FILENAME", help="merge the finished shards into FILENAME")
+    args = parser.parse_args()
+
+    if args.status:
+        print(shard_status(args.run_dir))
+        return
+    if args.merge:
+        merge_shards(args.run_dir, args.merge)
+        return
+
+    if args.processes > 1:
+        run_sharded_local(args.run_dir, processes=args.processes, batch_size=args.batch_size,
+                          claim_timeout=args.claim_timeout)
+    else:
+        run_shard_worker(args.run_dir, batch_size=args.batch_size, claim_timeout=args.claim_timeout)
+    print(shard_status(args.run_dir))
+
+if __name__ == "__main__":
+    main()
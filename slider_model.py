@@ -1,7 +1,9 @@
 from dependencies import *
 from model import *
+from model_cache import *
 from background import *
 from defaults import *
+from MC_helpers import *
 
 import streamlit as st
 import scipy.stats as sst
@@ -89,8 +91,14 @@ with tab3:
 with col2:
     t_max = st.number_input(label='Run time (Myr)',
                                 value=3,step=1,min_value=1)
-
-t,N,B,H,P,E,degass_arr = run_model(dt=dt,t_max=t_max, # model setup
+    ensemble_on = st.checkbox('Ensemble mode',
+                              help="Also run an ensemble of background climate and parameter draws around these settings")
+    if ensemble_on:
+        ensemble_iters = st.select_slider('Ensemble size (runs)',options=[100,250,500,1000,2500,5000],value=1000)
+        spread = st.slider('Parameter spread (fraction of each range)',value=0.1,min_value=0.,max_value=0.5)
+
+# cached: rerenders with unchanged inputs don't rerun the model
+t,N,B,H,P,E,degass_arr = cached_run_model(dt=dt,t_max=t_max, # model setup
                            emp_dur=emp_dur,A0=A0, # LIP emplacement characteristics
                            B0=B0,erup_freq=erup_freq, # LIP emplacement characteristics
                            degass=degass, # LIP degassing characteristics
@@ -147,4 +155,54 @@ def footer(text):
 
 """"""
 footer("Contact: Charlotte Minsky, cminsky@g.harvard.edu")
-footer("Source code: <a href='https://github.com/cminsky/snowball-LIP' style='color: grey;'>github.com/cminsky/snowball-LIP</a>")
\ No newline at end of file
+footer("Source code: <a href='https://github.com/cminsky/snowball-LIP' style='color: grey;'>github.com/cminsky/snowball-LIP</a>")
+
+## ensemble mode: batches run in a background thread and the bands are redrawn as they refine;
+## the ensemble for stale settings is cancelled as soon as a slider moves
+def ensemble_figure(bands,t,T):
+    fig,ax = plt.subplots(figsize=(6.4,4))
+    lower,q1,median,q3,upper = bands["bands"]
+    ax.fill_between(bands["t"],lower,upper,color='grey',alpha=0.2,label='95% of runs')
+    ax.fill_between(bands["t"],q1,q3,color='grey',alpha=0.4,label='50% of runs')
+    ax.plot(bands["t"],median,color='grey',label='Median')
+    ax.plot(t,T,color='k',label='Slider settings')
+    ax.axhline(280,c='cadetblue',label='Snowball threshold')
+    ax.set_ylabel('Temperature (K)')
+    ax.set_xlabel('Time (Myr)')
+    ax.set_ylim(270,295)
+    ax.legend(loc='lower left',frameon=False,ncols=2)
+
+    p,p_low,p_high = bands["estimates"]["snowball_flag_percentage"]
+    ax.set_title(f"Snowball in 0.9-2.15 Myr: {p:.1f}% (95% CI {p_low:.1f}-{p_high:.1f}%), "
+                 f"{bands['completed']:,} runs")
+    return fig
+
+if ensemble_on:
+    setting = dict(dt=dt,t_max=t_max,emp_dur=emp_dur,A0=A0,B0=B0,erup_freq=erup_freq,degass=degass,
+                   P0=P0,E_P=E_P,d=d,c=c,Xm=Xm,N0=N0,V=V,n=n,n_p=n_p,n_e=n_e,T0=T0,b=b,a=a)
+    ensemble_key = (tuple(setting.items()),ensemble_iters,spread,t_Earth)
+    job = st.session_state.get("ensemble_job")
+    if job is None or st.session_state.get("ensemble_key") != ensemble_key:
+        if job is not None:
+            cancel_ensemble(job)
+        job = start_ensemble(sample_ensemble(setting,ensemble_iters,t_Earth,spread=spread,seed=0))
+        st.session_state["ensemble_job"] = job
+        st.session_state["ensemble_key"] = ensemble_key
+
+    with col2:
+        placeholder = st.empty()
+    # a slider change stops this loop (Streamlit reruns the script), and the rerun cancels the job
+    while True:
+        finished = job["done"].is_set()
+        bands = ensemble_bands(job)
+        if bands is not None:
+            fig = ensemble_figure(bands,t,T)
+            placeholder.pyplot(fig)
+            plt.close(fig)
+        if job["error"] is not None:
+            placeholder.error(f"Ensemble failed: {job['error']}")
+        if finished:
+            break
+        time.sleep(0.5)
+elif "ensemble_job" in st.session_state:
+    cancel_ensemble(st.session_state.pop("ensemble_job"))
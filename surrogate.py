@@ -0,0 +1,90 @@
+from dependencies import *
+from model import *
+from param_table import *
+
+### fast surrogates for the minimum temperature of a run, used to screen samples before running the model
+
+# analytic lower bound on the min temperature before max_time (as in A.1_analytic_tests):
+# LIP weathering can't draw down more carbon than the erupted rock holds (supply-limited) or than
+# saprolite production allows by max_time (kinetic-limited), while background weathering and
+# degassing only pull the carbon inventory back up
+def analytic_min_temp(params, max_time=2.15):
+    p = {key: np.asarray(val, dtype=float) for key, val in params.items()}
+    erup_num = p["emp_dur"]/p["erup_freq"]
+    supply = p["A0"]*p["B0"]*(1 + 1/erup_num)*p["Xm"]/1e18 # all erupted rock (incl. the first flow) [examol]
+    y_max = ((p["N0"] + p["degass"])/p["N0"])**2 # highest possible normalized pCO2
+    kinetic = p["A0"]*p["P0"]*y_max**p["n_p"]*(max_time + p["dt"])*p["Xm"]/1e18 # [examol]
+    N_min = p["N0"] - np.minimum(supply, kinetic)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(N_min > 0, p["T0"] + x(N_min, p["N0"], p["b"], p["a"]), -np.inf)
+
+# parameters used by the fitted surrogate
+surrogate_keys = ["emp_dur", "A0", "B0", "erup_freq", "degass", "P0", "E_P", "c", "N0", "V", "n", "n_p", "n_e"]
+
+# linear and quadratic terms of the standardized parameters, plus the log analytic drawdown limits
+def surrogate_features(params, center, scale, max_time=2.15):
+    p = {key: np.asarray(val, dtype=float) for key, val in params.items()}
+    z = np.column_stack([(p[key] - center[i])/scale[i] for i, key in enumerate(surrogate_keys)])
+    erup_num = p["emp_dur"]/p["erup_freq"]
+    with np.errstate(divide='ignore'):
+        supply = np.log(p["A0"]*p["B0"]*(1 + 1/erup_num)*p["Xm"]/1e18/p["N0"])
+        kinetic = np.log(p["A0"]*np.maximum(p["P0"], 1e-6)*max_time*p["Xm"]/1e18/p["N0"])
+    i, j = np.triu_indices(z.shape[1])
+    return np.column_stack([np.ones(len(z)), z, z[:, i]*z[:, j], supply, kinetic,
+                            np.minimum(supply, kinetic)])
+
+# fit a surrogate for the min temperature before max_time to finished runs (params as sampled,
+# min_normed_temp as in the stats group), by ridge regression of the log pCO2 drawdown
+# the default screening margin is set on held-out runs so that at most miss_rate of the runs that did
+# cross threshold_temp would have been screened
+def fit_surrogate(params, min_normed_temp, threshold_temp=280, max_time=2.15, ridge=1e-3, miss_rate=1e-3, seed=0):
+    p = {key: np.asarray(val, dtype=float) for key, val in params.items()}
+    target = np.asarray(min_normed_temp, dtype=float) * p["a"]/p["b"] # log of the normalized pCO2 minimum
+    valid = np.isfinite(target)
+    p = {key: val[valid] for key, val in p.items()}
+    target = target[valid]
+
+    # half the runs to fit, half to estimate the margin
+    order = np.random.default_rng(seed).permutation(len(target))
+    fit, test = order[:len(order)//2], order[len(order)//2:]
+    center = np.array([p[key][fit].mean() for key in surrogate_keys])
+    scale = np.array([p[key][fit].std() or 1 for key in surrogate_keys])
+    features = surrogate_features(p, center, scale, max_time)
+    features[~np.isfinite(features)] = -50 # no rock or no weathering: far from any snowball
+    lhs = features[fit].T @ features[fit] + ridge*np.eye(features.shape[1])
+    coef = np.linalg.solve(lhs, features[fit].T @ target[fit])
+
+    surrogate = {"center": center, "scale": scale, "coef": coef, "max_time": max_time}
+    predicted = fitted_min_temp({key: val[test] for key, val in p.items()}, surrogate)
+    crossed = p["T0"][test] + target[test]*p["b"][test]/p["a"][test] < threshold_temp
+    surrogate["margin"] = max(np.quantile(predicted[crossed] - threshold_temp, 1 - miss_rate), 0) if crossed.any() else 0
+    return surrogate
+
+# fit a surrogate to the params and stats groups of a saved run
+def fit_surrogate_file(filename, **kwargs):
+    params = table_params(read_param_table(filename))
+    with netCDF4.Dataset(filename, "r") as ncfile:
+        min_normed_temp = np.ma.filled(ncfile.groups["stats"].variables["min_normed_temp"][:], np.nan)
+        max_time = getattr(ncfile.groups["stats"], "max_time", 2.15)
+    return fit_surrogate(params, min_normed_temp, max_time=kwargs.pop("max_time", max_time), **kwargs)
+
+# min temperature before max_time predicted by a fitted surrogate (never below the analytic bound)
+def fitted_min_temp(params, surrogate):
+    p = {key: np.asarray(val, dtype=float) for key, val in params.items()}
+    features = surrogate_features(p, surrogate["center"], surrogate["scale"], surrogate["max_time"])
+    features[~np.isfinite(features)] = -50
+    predicted = p["T0"] + (features @ surrogate["coef"])*p["b"]/p["a"]
+    predicted = np.minimum(predicted, p["T0"]) # the initial temperature is part of the window
+    return np.maximum(predicted, analytic_min_temp(p, surrogate["max_time"]))
+
+# flag runs predicted to stay warmer than threshold_temp + margin before max_time, which can't produce
+# a late, early or snowball flag; with surrogate=None the analytic bound is used (margin 0 is exact)
+# returns the screened flags and the predicted min temperatures
+def screen_params(params, surrogate=None, threshold_temp=280, margin=None, max_time=2.15):
+    if surrogate is None:
+        predicted = analytic_min_temp(params, max_time)
+        margin = margin or 0
+    else:
+        predicted = fitted_min_temp(params, surrogate)
+        margin = surrogate["margin"] if margin is None else margin
+    return predicted > threshold_temp + margin, predicted